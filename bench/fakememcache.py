@@ -0,0 +1,111 @@
+'''In-memory stand-in for memcache.Client, for running the resolver offline.
+
+  mc = FakeMemcache()
+  engine = resolver.Resolver(config, mc=mc)
+
+Implements the commands the resolver uses with memcached's semantics:
+expiry times (relative up to 30 days, absolute after), add only storing
+missing keys, incr only touching existing ones, and items over the size
+limit refused.
+'''
+import threading
+
+from time import time
+
+MAX_RELATIVE = 30 * 24 * 3600
+
+class FakeMemcache(object):
+
+  def __init__(self, maxValueLength=1024 * 1024):
+    super(FakeMemcache, self).__init__()
+    self.maxValueLength = maxValueLength
+    self.lock = threading.Lock()
+    self.items = dict() # key -> (value, expires or 0)
+    self.calls = 0
+
+  def _expires(self, ttl):
+    if not ttl:
+      return 0
+    return ttl if ttl > MAX_RELATIVE else time() + ttl
+
+  def _get(self, key):
+    item = self.items.get(key)
+    if item and item[1] and item[1] < time():
+      del self.items[key]
+      return None
+    return item
+
+  def _fits(self, val):
+    return not isinstance(val, str) or len(val) <= self.maxValueLength
+
+  def get(self, key):
+    with self.lock:
+      self.calls += 1
+      item = self._get(key)
+      return item and item[0]
+
+  def get_multi(self, keys, key_prefix=''):
+    with self.lock:
+      self.calls += 1
+      found = dict()
+      for key in keys:
+        item = self._get(key_prefix + key)
+        if item:
+          found[key] = item[0]
+      return found
+
+  def set(self, key, val, time=0):
+    with self.lock:
+      self.calls += 1
+      if not self._fits(val):
+        return False
+      self.items[key] = (val, self._expires(time))
+      return True
+
+  def set_multi(self, mapping, time=0, key_prefix=''):
+    '''returns the keys that weren't stored'''
+    with self.lock:
+      self.calls += 1
+      notStored = []
+      for key, val in mapping.items():
+        if self._fits(val):
+          self.items[key_prefix + key] = (val, self._expires(time))
+        else:
+          notStored.append(key)
+      return notStored
+
+  def add(self, key, val, time=0):
+    with self.lock:
+      self.calls += 1
+      if self._get(key) or not self._fits(val):
+        return False
+      self.items[key] = (val, self._expires(time))
+      return True
+
+  def incr(self, key, delta=1):
+    with self.lock:
+      self.calls += 1
+      item = self._get(key)
+      if not item:
+        return None
+      value = int(item[0]) + delta
+      self.items[key] = (str(value), item[1])
+      return value
+
+  def delete(self, key, time=0):
+    with self.lock:
+      self.calls += 1
+      return self.items.pop(key, None) is not None and 1 or 0
+
+  def delete_multi(self, keys, time=0, key_prefix=''):
+    with self.lock:
+      self.calls += 1
+      for key in keys:
+        self.items.pop(key_prefix + key, None)
+      return 1
+
+  def flush_all(self):
+    with self.lock:
+      self.items.clear()
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
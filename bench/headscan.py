@@ -0,0 +1,82 @@
+'''Benchmark: streaming head scan vs. a full BeautifulSoup parse of each page.
+
+  python -m bench.headscan [-n ITERATIONS] [PAGE ...]
+
+PAGEs are saved HTML files; without any, a synthetic corpus of small,
+medium and portal-sized pages is used. Peak memory is measured in a forked
+child per parser, as the growth of its max RSS.
+'''
+import argparse
+import os
+import resource
+import StringIO
+import time
+
+import globals
+import htmlscan
+
+from BeautifulSoup import BeautifulSoup
+from bench import samples
+
+HEAD = '<meta charset="utf-8"><link rel="stylesheet" href="/s.css">' + \
+       '<script src="/a.js"></script>' * 10 + \
+       '<link rel="shortcut icon" href="/favicon.ico">'
+
+def corpus():
+  return [('small-10k', samples.html(HEAD, bodyBytes=10 * 1024)),
+          ('medium-200k', samples.html(HEAD, bodyBytes=200 * 1024)),
+          ('portal-2m', samples.html(HEAD, bodyBytes=2 * 1024 * 1024))]
+
+def soupHref(page):
+  link = BeautifulSoup(page).find('link', rel=globals.RE_LINKTAG)
+  return link and link.get('href')
+
+def scanHref(page):
+  link = htmlscan.scan(StringIO.StringIO(page)).icon()
+  return link and link.get('href')
+
+def timed(fn, page, iterations):
+  start = time.time()
+  for i in xrange(iterations):
+    fn(page)
+  return (time.time() - start) / iterations
+
+def peakMemory(fn, page):
+  '''KB the max RSS of a forked child grows by while running fn(page)'''
+  read, write = os.pipe()
+  pid = os.fork()
+  if not pid:
+    os.close(read)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn(page)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    os.write(write, str(after - before))
+    os._exit(0)
+  os.close(write)
+  growth = int(os.read(read, 64) or 0)
+  os.close(read)
+  os.waitpid(pid, 0)
+  return growth
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('-n', '--iterations', type=int, default=5)
+  parser.add_argument('pages', nargs='*')
+  args = parser.parse_args()
+
+  pages = [(os.path.basename(path), open(path).read()) for path in args.pages] \
+          or corpus()
+
+  print '%-20s %9s %7s %10s %10s %10s %10s' % ('page', 'bytes', 'same',
+      'soup (ms)', 'scan (ms)', 'soup (KB)', 'scan (KB)')
+  for name, page in pages:
+    print '%-20s %9d %7s %10.2f %10.2f %10d %10d' % (name, len(page),
+        soupHref(page) == scanHref(page),
+        timed(soupHref, page, args.iterations) * 1000,
+        timed(scanHref, page, args.iterations) * 1000,
+        peakMemory(soupHref, page), peakMemory(scanHref, page))
+
+if __name__ == '__main__':
+  main()
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
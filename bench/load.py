@@ -0,0 +1,143 @@
+'''Load test: cold and warm cache runs of the resolver against bench.origin.
+
+  python -m bench.load [-d DOMAINS] [-c CONCURRENCY] [--timeout SECONDS]
+                       [--scenarios link,root,...] [--sample-rate RATE] [--json]
+
+Runs entirely offline: origins are simulated by bench.origin in a child
+process, used as the HTTP proxy, and memcache is bench.fakememcache. Each
+run resolves every domain once with CONCURRENCY threads, calling
+Resolver.resolve the way /s does:
+
+  cold       empty caches, every domain goes to its origin
+  warm       the same domains again, from the local cache
+  memcache   local cache dropped, from memcache
+
+For each run it reports throughput, p50/p95/p99 latency, icons found vs.
+defaults, the CPU time used and the peak RSS of this process; the origin's
+work is not counted.
+'''
+import argparse
+import cherrypy
+import json
+import multiprocessing
+import os
+import Queue
+import resource
+import threading
+
+import globals
+import resolver
+
+from bench import fakememcache, origin
+from time import time
+
+def serveOrigin(connection):
+  server = origin.Server(('127.0.0.1', 0), origin.Handler)
+  connection.send(server.server_address[1])
+  server.serve_forever()
+
+def startOrigin():
+  '''runs bench.origin in a child process, returns (process, port)'''
+  parentEnd, childEnd = multiprocessing.Pipe()
+  process = multiprocessing.Process(target=serveOrigin, args=(childEnd,))
+  process.daemon = True
+  process.start()
+  return process, parentEnd.recv()
+
+def percentile(ordered, fraction):
+  if not ordered:
+    return 0
+  return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def cpuTime():
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+def run(name, engine, urls, concurrency):
+  '''resolves urls with concurrency threads, returns the run's figures'''
+  queue = Queue.Queue()
+  for url in urls:
+    queue.put(url)
+  latencies, defaults = [], [0]
+  lock = threading.Lock()
+
+  def work():
+    while True:
+      try:
+        url = queue.get_nowait()
+      except Queue.Empty:
+        return
+      started = time()
+      icon, cacheHit = engine.resolve(url)
+      elapsed = time() - started
+      with lock:
+        latencies.append(elapsed)
+        defaults[0] += icon is engine.default_icon
+
+  cpu, started = cpuTime(), time()
+  threads = [threading.Thread(target=work) for i in xrange(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  wall = time() - started
+
+  ordered = sorted(latencies)
+  return {'run': name, 'requests': len(ordered),
+          'per_second': len(ordered) / wall, 'p50': percentile(ordered, 0.5),
+          'p95': percentile(ordered, 0.95), 'p99': percentile(ordered, 0.99),
+          'found': len(ordered) - defaults[0], 'defaults': defaults[0],
+          'cpu': cpuTime() - cpu, 'wall': wall,
+          # KB on Linux
+          'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('-d', '--domains', type=int, default=500)
+  parser.add_argument('-c', '--concurrency', type=int, default=50)
+  parser.add_argument('--timeout', type=float, default=3,
+                      help='resolution deadline, globals.TIMEOUT in production')
+  parser.add_argument('--scenarios', default=','.join(origin.SCENARIOS))
+  parser.add_argument('--sample-rate', type=float, default=0,
+                      help='metrics.sample_rate for the run')
+  parser.add_argument('--json', action='store_true')
+  args = parser.parse_args()
+
+  process, port = startOrigin()
+  os.environ['http_proxy'] = 'http://127.0.0.1:%d' % port
+  globals.TIMEOUT = args.timeout
+
+  scenarios = args.scenarios.split(',')
+  urls = ['http://%s-%d.bench' % (scenarios[i % len(scenarios)], i)
+          for i in xrange(args.domains)]
+
+  cherrypy.log.screen = False
+  # every request goes through the origin, as a proxy: don't let the
+  # per-host connection limit throttle the whole run
+  engine = resolver.Resolver({'metrics.sample_rate': args.sample_rate,
+                              'pool.max_per_host': args.concurrency * 10},
+                             mc=fakememcache.FakeMemcache())
+  results = [run('cold', engine, urls, args.concurrency),
+             run('warm', engine, urls, args.concurrency)]
+  engine.local.clear()
+  results.append(run('memcache', engine, urls, args.concurrency))
+  process.terminate()
+
+  if args.json:
+    print json.dumps(results, indent=2)
+    return
+
+  print '%-9s %8s %9s %8s %8s %8s %6s %8s %8s %8s' % ('run', 'requests',
+      'req/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'found', 'defaults',
+      'cpu (s)', 'rss (MB)')
+  for result in results:
+    print '%-9s %8d %9.1f %8.1f %8.1f %8.1f %6d %8d %8.2f %8.1f' % \
+        (result['run'], result['requests'], result['per_second'],
+         result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000,
+         result['found'], result['defaults'], result['cpu'],
+         result['max_rss_mb'])
+
+if __name__ == '__main__':
+  main()
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
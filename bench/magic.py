@@ -0,0 +1,38 @@
+'''Micro-benchmark: in-process sniffing vs. forking `file` per icon.
+
+  python -m bench.magic [-n ITERATIONS]
+'''
+import argparse
+import time
+
+import resolver
+import sniff
+
+from bench import samples
+
+def timeit(fn, data, iterations):
+  start = time.time()
+  for i in xrange(iterations):
+    fn(data)
+  return (time.time() - start) / iterations
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('-n', '--iterations', type=int, default=200)
+  args = parser.parse_args()
+
+  print '%-6s %-22s %-22s %12s %12s %8s' % \
+      ('format', 'sniff', 'file', 'sniff (us)', 'file (us)', 'speedup')
+  for name, data in samples.CORPUS:
+    sniffed = sniff.sniff(data)
+    forked = resolver.filecommand(data)
+    sniffTime = timeit(sniff.sniff, data, args.iterations * 100)
+    forkTime = timeit(resolver.filecommand, data, args.iterations)
+    print '%-6s %-22s %-22s %12.1f %12.1f %7.0fx' % \
+        (name, sniffed, forked, sniffTime * 1e6, forkTime * 1e6,
+         forkTime / sniffTime)
+
+if __name__ == '__main__':
+  main()
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
@@ -0,0 +1,147 @@
+'''Simulated origins for offline benchmarks.
+
+  python -m bench.origin [-p PORT]
+
+Runs an HTTP server meant to be used as the resolver's proxy
+(http_proxy=http://127.0.0.1:PORT), so it answers for every host. What a
+host serves depends on the scenario its name starts with,
+<scenario>-<n>.bench:
+
+  link       page declaring /icon.png in a <link> tag
+  root       plain page, icon at /favicon.ico
+  redirect   root redirects to www.<host>, which is a `link` site
+  refresh    page meta-refreshes to /landing, which declares the icon
+  slowbody   icon body trickled out over SLOW_BODY_TIME seconds
+  gzip       gzipped ICO at /favicon.ico
+  hugepage   `link` site whose page carries a large body
+  notfound   404 for everything, resolves to the default icon
+  timeout    no response for HANG_TIME seconds, resolves to the default icon
+
+www.<host> serves what <host> does, but for `redirect`. Other hosts get a
+PNG for image paths, which serves the default icon, and 404s otherwise.
+'''
+import argparse
+import BaseHTTPServer
+import socket
+import SocketServer
+import sys
+import threading
+import urlparse
+
+from bench import samples
+from time import sleep
+
+SCENARIOS = ['link', 'root', 'redirect', 'refresh', 'slowbody', 'gzip',
+             'hugepage', 'notfound', 'timeout']
+SLOW_BODY_TIME = 1.0 # seconds
+HANG_TIME = 30 # seconds
+HUGE_PAGE_BYTES = 2 * 1024 * 1024
+
+ICON = samples.png(32, 32)
+GZIPPED = samples.gzipped(samples.ico())
+LINK_PAGE = samples.html('<link rel="icon" href="/icon.png">', bodyBytes=2000)
+HUGE_PAGE = samples.html('<link rel="icon" href="/icon.png">',
+                         bodyBytes=HUGE_PAGE_BYTES)
+PLAIN_PAGE = samples.html(bodyBytes=2000)
+REFRESH_PAGE = samples.html('<meta http-equiv="refresh" content="0; url=/landing">')
+
+def scenario(host):
+  name = host.split('-', 1)[0]
+  if name == 'www.redirect':
+    return 'link'
+  if name.startswith('www.'):
+    name = name[4:]
+  return name if name in SCENARIOS else None
+
+def respond(host, path):
+  '''(status, headers, body or list of chunks, delay) for a request'''
+  name = scenario(host)
+  if name is None:
+    if path.endswith('.png') or path.endswith('.ico'):
+      return 200, {'Content-Type': 'image/png'}, ICON, 0
+    return 404, {'Content-Type': 'text/html'}, 'not found', 0
+
+  page = path in ('', '/')
+  if name == 'notfound':
+    return 404, {'Content-Type': 'text/html'}, 'not found', 0
+  if name == 'timeout':
+    return 200, {'Content-Type': 'text/html'}, PLAIN_PAGE, HANG_TIME
+  if name == 'redirect' and page:
+    return 301, {'Location': 'http://www.%s/' % host}, '', 0
+  if name == 'refresh':
+    if page:
+      return 200, {'Content-Type': 'text/html'}, REFRESH_PAGE, 0
+    if path == '/landing':
+      return 200, {'Content-Type': 'text/html'}, LINK_PAGE, 0
+  if name in ('link', 'hugepage') and page:
+    return 200, {'Content-Type': 'text/html'}, \
+           HUGE_PAGE if name == 'hugepage' else LINK_PAGE, 0
+  if page:
+    return 200, {'Content-Type': 'text/html'}, PLAIN_PAGE, 0
+
+  if name == 'gzip' and path == '/favicon.ico':
+    return 200, {'Content-Type': 'image/x-icon'}, GZIPPED, 0
+  if name == 'slowbody' and path == '/favicon.ico':
+    chunks = [ICON[i:i + 64] for i in xrange(0, len(ICON), 64)]
+    return 200, {'Content-Type': 'image/png'}, chunks, 0
+  if (name in ('link', 'hugepage', 'refresh') and path == '/icon.png') or \
+     (name in ('root', 'redirect') and path == '/favicon.ico'):
+    return 200, {'Content-Type': 'image/png'}, ICON, 0
+  return 404, {'Content-Type': 'text/html'}, 'not found', 0
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    host = url.netloc or self.headers.get('Host', '')
+    status, headers, body, delay = respond(host.split(':')[0], url.path)
+    if delay:
+      sleep(delay)
+
+    chunks = body if isinstance(body, list) else [body]
+    self.send_response(status)
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(sum(len(c) for c in chunks)))
+    self.end_headers()
+    for chunk in chunks:
+      self.wfile.write(chunk)
+      if len(chunks) > 1:
+        self.wfile.flush()
+        sleep(SLOW_BODY_TIME / len(chunks))
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+  def handle_error(self, request, clientAddress):
+    # the resolver hangs up on origins still answering past its deadline
+    if not isinstance(sys.exc_info()[1], socket.error):
+      BaseHTTPServer.HTTPServer.handle_error(self, request, clientAddress)
+
+def start(port=0):
+  '''serves in a background thread, returns the server'''
+  server = Server(('127.0.0.1', port), Handler)
+  thread = threading.Thread(target=server.serve_forever, name='origin')
+  thread.daemon = True
+  thread.start()
+  return server
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('-p', '--port', type=int, default=8081)
+  args = parser.parse_args()
+
+  server = Server(('127.0.0.1', args.port), Handler)
+  print 'origin on http://127.0.0.1:%d' % server.server_address[1]
+  server.serve_forever()
+
+if __name__ == '__main__':
+  main()
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
@@ -0,0 +1,82 @@
+'''Synthetic payloads in the formats origins serve as favicons'''
+import gzip
+import StringIO
+import struct
+import zlib
+
+def png(width=16, height=16, rgba=(0x80, 0x20, 0x20, 0xff)):
+  row = '\x00' + struct.pack('BBBB', *rgba) * width
+  def chunk(tag, data):
+    crc = zlib.crc32(tag + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+  header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+  return '\x89PNG\r\n\x1a\n' + chunk('IHDR', header) + \
+         chunk('IDAT', zlib.compress(row * height)) + chunk('IEND', '')
+
+def ico(images=None):
+  '''ICO container around PNG images'''
+  images = images or [(16, png(16, 16)), (32, png(32, 32))]
+  offset = 6 + 16 * len(images)
+  directory, data = [], []
+  for size, image in images:
+    directory.append(struct.pack('<BBBBHHII', size % 256, size % 256, 0, 0, 1,
+                                 32, len(image), offset))
+    data.append(image)
+    offset += len(image)
+  return struct.pack('<HHH', 0, 1, len(images)) + ''.join(directory) + \
+         ''.join(data)
+
+def gif():
+  return 'GIF89a\x10\x00\x10\x00\x80\x00\x00\xff\xff\xff\x00\x00\x00!\xf9' + \
+         '\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x10\x00\x10\x00\x00\x02' + \
+         '\x0e\x84\x8f\xa9\xcb\xed\x0f\xa3\x9c\xb4\xda\x8b\xb3>\x05\x00;'
+
+def jpeg():
+  return '\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00' + \
+         '\x00' * 200 + '\xff\xd9'
+
+def bmp(width=16, height=16):
+  pixels = '\x20\x20\x80\xff' * width * height
+  header = struct.pack('<IiiHHIIiiII', 40, width, height, 1, 32, 0, len(pixels),
+                       2835, 2835, 0, 0)
+  return 'BM' + struct.pack('<IHHI', 14 + len(header) + len(pixels), 0, 0, 54) + \
+         header + pixels
+
+def svg():
+  return '<?xml version="1.0" encoding="UTF-8"?>\n' + \
+         '<svg xmlns="http://www.w3.org/2000/svg" width="16" height="16">' + \
+         '<rect width="16" height="16" fill="#802020"/></svg>'
+
+def webp():
+  return 'RIFF\x24\x00\x00\x00WEBPVP8 \x18\x00\x00\x00' + '\x00' * 24
+
+def gzipped(data):
+  buf = StringIO.StringIO()
+  f = gzip.GzipFile(fileobj=buf, mode='wb')
+  f.write(data)
+  f.close()
+  return buf.getvalue()
+
+def html(head='', body='', bodyBytes=0):
+  filler = '<p>%s</p>\n' % ('lorem ipsum dolor sit amet ' * 3)
+  padding = filler * (bodyBytes / len(filler) + 1) if bodyBytes else ''
+  return '<!DOCTYPE html>\n<html><head><title>page</title>%s</head>' \
+         '<body>%s%s</body></html>' % (head, body, padding)
+
+def xml():
+  return '<?xml version="1.0" encoding="UTF-8"?>\n<error><code>404</code></error>'
+
+CORPUS = [
+  ('ico', ico()),
+  ('png', png()),
+  ('gif', gif()),
+  ('jpeg', jpeg()),
+  ('bmp', bmp()),
+  ('svg', svg()),
+  ('webp', webp()),
+  ('gzip', gzipped(ico())),
+  ('html', html(bodyBytes=2000)),
+  ('xml', xml()),
+]
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
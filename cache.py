@@ -0,0 +1,192 @@
+import hashlib
+import threading
+
+from time import time
+
+class LRUCache(object):
+  '''Bounded, thread-safe LRU cache with per-entry expiry.
+  Capacity is a byte budget; sizeof(value) gives each entry's cost.'''
+
+  # indices into the linked list nodes
+  PREV, NEXT, KEY, VALUE, SIZE, EXPIRES = range(6)
+
+  def __init__(self, maxBytes, ttl, sizeof=len):
+    super(LRUCache, self).__init__()
+    self.maxBytes = maxBytes
+    self.ttl = ttl
+    self.sizeof = sizeof
+
+    self.lock = threading.Lock()
+    self.map = dict()
+    self.root = []
+    self.root[:] = [self.root, self.root, None, None, 0, 0]
+    self.bytes = 0
+
+    self.hits = self.misses = self.evictions = self.expirations = 0
+
+  def _unlink(self, node):
+    node[self.PREV][self.NEXT] = node[self.NEXT]
+    node[self.NEXT][self.PREV] = node[self.PREV]
+
+  def _linkFront(self, node):
+    first = self.root[self.NEXT]
+    node[self.PREV] = self.root
+    node[self.NEXT] = first
+    first[self.PREV] = node
+    self.root[self.NEXT] = node
+
+  def _remove(self, node):
+    self._unlink(node)
+    del self.map[node[self.KEY]]
+    self.bytes -= node[self.SIZE]
+
+  def get(self, key):
+    with self.lock:
+      node = self.map.get(key)
+      if node is None:
+        self.misses += 1
+        return None
+      if node[self.EXPIRES] < time():
+        self._remove(node)
+        self.expirations += 1
+        self.misses += 1
+        return None
+      self._unlink(node)
+      self._linkFront(node)
+      self.hits += 1
+      return node[self.VALUE]
+
+  def set(self, key, value, ttl=None):
+    size = self.sizeof(value)
+    if size > self.maxBytes:
+      return False
+    expires = time() + (ttl if ttl is not None else self.ttl)
+
+    with self.lock:
+      node = self.map.get(key)
+      if node is not None:
+        self._remove(node)
+      node = [None, None, key, value, size, expires]
+      self._linkFront(node)
+      self.map[key] = node
+      self.bytes += size
+
+      while self.bytes > self.maxBytes:
+        self._remove(self.root[self.PREV])
+        self.evictions += 1
+    return True
+
+  def delete(self, key):
+    with self.lock:
+      node = self.map.get(key)
+      if node is not None:
+        self._remove(node)
+
+  def items(self, limit=None):
+    '''[(key, value)] of the entries that haven't expired, most recently
+    used first, at most limit of them'''
+    items, now = [], time()
+    with self.lock:
+      node = self.root[self.NEXT]
+      while node is not self.root and (limit is None or len(items) < limit):
+        if node[self.EXPIRES] >= now:
+          items.append((node[self.KEY], node[self.VALUE]))
+        node = node[self.NEXT]
+    return items
+
+  def clear(self):
+    with self.lock:
+      self.map.clear()
+      self.root[:] = [self.root, self.root, None, None, 0, 0]
+      self.bytes = 0
+
+  def stats(self):
+    with self.lock:
+      return {'items': len(self.map), 'bytes': self.bytes,
+              'max_bytes': self.maxBytes, 'hits': self.hits,
+              'misses': self.misses, 'evictions': self.evictions,
+              'expirations': self.expirations}
+
+class NegativeCache(object):
+  '''Remembers failed fetches in memcache, keyed by url, for a time that
+  depends on the kind of failure (ttls maps kind to seconds)'''
+
+  def __init__(self, mc, ttls, keyFormat):
+    super(NegativeCache, self).__init__()
+    self.mc = mc
+    self.ttls = ttls
+    self.keyFormat = keyFormat
+    self.hits = self.adds = 0
+
+  def key(self, url):
+    # urls can be longer than memcache keys may be, or contain spaces
+    return self.keyFormat % hashlib.md5(url).hexdigest()
+
+  def get(self, url):
+    kind = self.mc.get(self.key(url))
+    if kind:
+      self.hits += 1
+    return kind
+
+  def add(self, url, kind):
+    self.adds += 1
+    self.mc.set(self.key(url), kind, time=self.ttls[kind])
+
+  def failures(self, urls):
+    '''{url: kind} for the urls with a failure recorded'''
+    keys = dict((self.key(url), url) for url in urls)
+    return dict((keys[key], kind)
+                for key, kind in self.mc.get_multi(keys.keys()).items())
+
+  def stats(self):
+    return {'hits': self.hits, 'adds': self.adds}
+
+class HostBackoff(object):
+  '''In-process exponential backoff for hosts that fail to answer: after
+  n consecutive failures a host is skipped for base * 2^(n-1) seconds, up to
+  maximum'''
+
+  def __init__(self, base, maximum, maxHosts=10000):
+    super(HostBackoff, self).__init__()
+    self.base = base
+    self.maximum = maximum
+    self.maxHosts = maxHosts
+    self.lock = threading.Lock()
+    self.hosts = dict() # host -> (consecutive failures, blocked until)
+    self.skips = 0
+
+  def blocked(self, host):
+    entry = self.hosts.get(host)
+    if entry and entry[1] > time():
+      self.skips += 1
+      return True
+    return False
+
+  def remaining(self, host):
+    '''whole seconds host stays blocked for, 0 when it isn't'''
+    entry = self.hosts.get(host)
+    now = time()
+    return int(entry[1] - now) + 1 if entry and entry[1] > now else 0
+
+  def failure(self, host):
+    with self.lock:
+      if len(self.hosts) > self.maxHosts:
+        now = time()
+        for stale in [h for h, (f, until) in self.hosts.items() if until < now]:
+          del self.hosts[stale]
+      failures = self.hosts.get(host, (0, 0))[0] + 1
+      delay = min(self.base * 2 ** (failures - 1), self.maximum)
+      self.hosts[host] = (failures, time() + delay)
+
+  def success(self, host):
+    if host in self.hosts:
+      with self.lock:
+        self.hosts.pop(host, None)
+
+  def stats(self):
+    now = time()
+    with self.lock:
+      blocked = len([1 for f, until in self.hosts.values() if until > now])
+    return {'hosts_backing_off': blocked, 'skips': self.skips}
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
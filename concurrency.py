@@ -0,0 +1,254 @@
+import Queue
+import sys
+import threading
+
+from time import time
+
+class Future(object):
+  '''result of a callable submitted to a WorkerPool'''
+
+  def __init__(self):
+    super(Future, self).__init__()
+    self.event = threading.Event()
+    self.cancelled = False
+    self.value = None
+    self.excInfo = None
+
+  def cancel(self):
+    '''Stops the callable from starting if it hasn't already'''
+    self.cancelled = True
+
+  def done(self):
+    return self.event.isSet()
+
+  def setResult(self, value):
+    self.value = value
+    self.event.set()
+
+  def setException(self, excInfo):
+    self.excInfo = excInfo
+    self.event.set()
+
+  def result(self, timeout=None):
+    '''waits up to timeout seconds, re-raising whatever the callable raised.
+    Returns None if the callable hasn't finished in time'''
+    self.event.wait(timeout)
+    if not self.event.isSet():
+      return None
+    if self.excInfo:
+      raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+    return self.value
+
+class WorkerPool(object):
+  '''fixed set of daemon threads consuming a shared queue of callables.
+  Threads are started on first use.'''
+
+  def __init__(self, size, name='worker'):
+    super(WorkerPool, self).__init__()
+    self.size = size
+    self.name = name
+    self.queue = Queue.Queue()
+    self.lock = threading.Lock()
+    self.threads = []
+
+  def _start(self):
+    with self.lock:
+      while len(self.threads) < self.size:
+        thread = threading.Thread(target=self._work,
+            name='%s-%d' % (self.name, len(self.threads)))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+  def _work(self):
+    while True:
+      future, fn, args, kwargs = self.queue.get()
+      if future.cancelled:
+        future.setResult(None)
+        continue
+      try:
+        future.setResult(fn(*args, **kwargs))
+      except:
+        future.setException(sys.exc_info())
+
+  def submit(self, fn, *args, **kwargs):
+    if len(self.threads) < self.size:
+      self._start()
+    future = Future()
+    self.queue.put((future, fn, args, kwargs))
+    return future
+
+  def pending(self):
+    return self.queue.qsize()
+
+class SingleFlight(object):
+  '''Collapses concurrent calls for the same key into one: the first caller
+  (the leader) runs fn, callers arriving while it runs wait for its result'''
+
+  def __init__(self):
+    super(SingleFlight, self).__init__()
+    self.lock = threading.Lock()
+    self.calls = dict()
+    self.leaders = self.coalesced = self.timeouts = 0
+
+  def do(self, key, fn, timeout):
+    '''returns (result, shared). Followers get None if the leader hasn't
+    finished within timeout seconds, and see the leader's exceptions.'''
+    with self.lock:
+      call = self.calls.get(key)
+      leader = call is None
+      if leader:
+        call = self.calls[key] = Future()
+        self.leaders += 1
+      else:
+        self.coalesced += 1
+
+    if not leader:
+      result = call.result(timeout)
+      if not call.done():
+        with self.lock:
+          self.timeouts += 1
+      return result, True
+
+    try:
+      result = fn()
+      call.setResult(result)
+      return result, False
+    except:
+      call.setException(sys.exc_info())
+      raise
+    finally:
+      with self.lock:
+        del self.calls[key]
+
+  def stats(self):
+    with self.lock:
+      return {'in_flight': len(self.calls), 'leaders': self.leaders,
+              'coalesced': self.coalesced, 'timeouts': self.timeouts}
+
+class RefreshQueue(object):
+  '''Background jobs on a small WorkerPool, at most one queued or running per
+  key and at most maxDepth in total; anything beyond that is dropped'''
+
+  def __init__(self, fn, threads, maxDepth, name='refresh'):
+    super(RefreshQueue, self).__init__()
+    self.fn = fn
+    self.maxDepth = maxDepth
+    self.pool = WorkerPool(threads, name=name)
+    self.lock = threading.Lock()
+    self.pending = set()
+    self.queued = self.deduped = self.dropped = self.done = self.failed = 0
+
+  def enqueue(self, key, *args):
+    '''returns whether a job was queued'''
+    with self.lock:
+      if key in self.pending:
+        self.deduped += 1
+        return False
+      if len(self.pending) >= self.maxDepth:
+        self.dropped += 1
+        return False
+      self.pending.add(key)
+      self.queued += 1
+    self.pool.submit(self._run, key, args)
+    return True
+
+  def _run(self, key, args):
+    try:
+      self.fn(*args)
+      self.done += 1
+    except:
+      self.failed += 1
+      raise
+    finally:
+      with self.lock:
+        self.pending.discard(key)
+
+  def stats(self):
+    with self.lock:
+      return {'depth': len(self.pending), 'queued': self.queued,
+              'deduped': self.deduped, 'dropped': self.dropped,
+              'done': self.done, 'failed': self.failed}
+
+class Admission(object):
+  '''Concurrency budget: at most limit callers between enter() and leave()
+  at once. Beyond it enter() refuses rather than waits, unless forced.'''
+
+  def __init__(self, limit):
+    super(Admission, self).__init__()
+    self.limit = limit
+    self.lock = threading.Lock()
+    self.inside = 0
+    self.admitted = self.shed = 0
+
+  def enter(self, force=False):
+    '''returns whether the caller got in, and must leave()'''
+    with self.lock:
+      if self.inside >= self.limit and not force:
+        self.shed += 1
+        return False
+      self.inside += 1
+      self.admitted += 1
+      return True
+
+  def leave(self):
+    with self.lock:
+      self.inside -= 1
+
+  def stats(self):
+    with self.lock:
+      return {'limit': self.limit, 'in_flight': self.inside,
+              'admitted': self.admitted, 'shed': self.shed}
+
+class Deadline(object):
+  '''Point in time a piece of work has to be done by, handed down the call
+  chain so every step sees how much of the budget is left'''
+
+  def __init__(self, seconds, parent=None):
+    super(Deadline, self).__init__()
+    self.started = time()
+    self.expires = self.started + seconds
+    if parent:
+      self.expires = min(self.expires, parent.expires)
+
+  def remaining(self):
+    '''seconds left, negative once overrun'''
+    return self.expires - time()
+
+  def expired(self):
+    return time() >= self.expires
+
+  def elapsed(self):
+    return time() - self.started
+
+  def share(self, fraction):
+    '''child deadline getting fraction of the time left, never outliving
+    this one'''
+    return Deadline(max(0, self.remaining()) * fraction, parent=self)
+
+def race(pool, probes, fanout, timeout):
+  '''Runs probes (callables, highest priority first) on pool with at most
+  fanout of them in flight, and returns the first truthy result in priority
+  order: the same answer as `probes[0]() or probes[1]() or ...`.
+  Lower priority probes still queued once a winner is known are cancelled.
+  Returns None when nothing succeeds within timeout seconds.'''
+  deadline = time() + timeout
+  futures = []
+
+  try:
+    for i in xrange(len(probes)):
+      while len(futures) < min(len(probes), i + fanout):
+        futures.append(pool.submit(probes[len(futures)]))
+
+      remaining = deadline - time()
+      if remaining <= 0:
+        return None
+      result = futures[i].result(remaining)
+      if result:
+        return result
+    return None
+  finally:
+    for future in futures:
+      future.cancel()
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
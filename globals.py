@@ -11,14 +11,48 @@ MIN_ICON_LENGTH = 100
 MAX_ICON_LENGTH = 20000
 
 MC_CACHE_TIME = 2419200 # seconds (28 days)
+MC_DEAD_RETRY = 30 # seconds a failed memcache node is skipped for
 
 KEY_FORMAT = 'icon_loc-%s'
+# written under KEY_FORMAT by /clear, so every node drops its disk entry
+EVICTED_LOC = 'evicted'
+EVICTED_TIME = 86400 # seconds, past it disk entries are refreshed anyway
+REDIRECT_KEY_FORMAT = 'redirect-%s'
+REDIRECT_CACHE_TIME = 86400 # seconds, where a domain's root page redirects
+ICON_KEY_FORMAT = 'icon-%s'
+
+# cached icons older than this are served while being refreshed in the
+# background, MC_CACHE_TIME is when they expire for good
+ICON_SOFT_TIME = 86400 # seconds (1 day)
+LOCAL_CACHE_TIME = 300 # seconds, bounds staleness vs. memcache and /clear
+LOCAL_CACHE_BYTES = 64 * 1024 * 1024
+SNAPSHOT_ITEMS = 20000 # hottest local cache entries kept across restarts
+STORE_MAX_BYTES = 1024 * 1024 * 1024 # segment size that triggers compaction
+# memcached refuses items over 1MB, leave headroom for key and pickle overhead
+MC_CHUNK_SIZE = 1000000 # bytes
+
+# bundled copy of https://publicsuffix.org/list/, next to publicsuffix.py
+PUBLIC_SUFFIX_LIST = 'public_suffix_list.dat'
 
 RE_URLDECODE = re.compile('%([0-9a-hA-H][0-9a-hA-H])', flags=re.MULTILINE)
 RE_LINKTAG = re.compile('^(shortcut|icon|shortcut icon)$', flags=re.IGNORECASE)
 RE_METAREFRESH = re.compile('url=([^;]+)', flags=re.IGNORECASE)
+RE_ICONREL = re.compile(r'(^|\s)(icon|apple-touch-icon(-precomposed)?)(\s|$)',
+                        flags=re.IGNORECASE)
+RE_ICONSIZE = re.compile(r'^(\d+)x(\d+)$', flags=re.IGNORECASE)
+
+MAX_HEAD_BYTES = 256 * 1024 # read no further looking for <link> tags
+
+DEFAULT_ICON_SIZE = 16 # pixels
+RENDITION_SIZES = [16, 32, 64] # pixels, computed for every icon found
+MAX_RENDITION_PIXELS = 1024 * 1024 # larger images aren't decoded
+RENDITION_KEY_FORMAT = 'rendition-%s-%d'
+MAX_CANDIDATES = 3 # icon declarations tried per page, best first
+CANDIDATES_KEY_FORMAT = 'candidates-%s'
 
 DEFAULT_FAVICON_LOC = 'http://d3gibmfbqm9w63.cloudfront.net/img/static/default_favicon.png'
+# what DEFAULT_FAVICON_LOC serves, bundled so starting up needs no network
+DEFAULT_FAVICON_FILE = 'static/default_favicon.png'
 HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows; U; Windows NT 6.1; en-US; ' +
                                   'rv:1.9.2.13) Gecko/20101203 Firefox/3.6.13'}
 
@@ -37,4 +71,51 @@ else:
 CONNECTION_TIMEOUT = 10
 TIMEOUT = 15
 
+POOL_MAX_PER_HOST = 8
+POOL_IDLE_TIMEOUT = 15 # seconds, below most servers' keep-alive timeout
+
+PROBE_FANOUT = 3 # fallback steps in flight per request
+PROBE_THREADS = 150
+RESOLVER_THREADS = 50
+PREFETCH_THREADS = 50
+
+# cache misses resolved at once, below server.thread_pool so that cache hits
+# always find a thread free; /s answers misses beyond it straight away
+MAX_RESOLUTIONS = 40
+SHED_RETRY_AFTER = 5 # seconds, how long clients keep a shed answer
+
+BATCH_MAX_URLS = 100
+BATCH_TIMEOUT = TIMEOUT # seconds, shared by all lookups in a batch
+
+COUNTER_FLUSH_INTERVAL = 10 # seconds between counter writes to memcache
+# share of pipeline stages timed into the latency histograms, 0 turns it off
+METRICS_SAMPLE_RATE = 0.1
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 15, 25] # seconds
+SLOW_RESOLUTION_TIME = 5 # seconds, resolutions logged as warnings past this
+# the fallback chain in Resolver.resolveDomain, in order
+STEP_NAMES = ['page', 'root', 'parent_page', 'parent_root', 'www_page',
+              'www_root', 'target_root']
+
+REFRESH_THREADS = 4
+REFRESH_MAX_DEPTH = 1000
+
+# failed fetches are remembered for a time depending on how they failed
+NEGATIVE_KEY_FORMAT = 'neg-%s'
+NEGATIVE_TTL = {
+  'timeout': 300, # seconds
+  'connect': 300,
+  'dns': 3600,
+  'http5xx': 600,
+  'http4xx': 86400,
+  'invalid': 86400,
+}
+BACKOFF_BASE = 30 # seconds, doubled for each consecutive failure
+BACKOFF_MAX = 3600
+
+# while one process resolves a domain, others wait for its result
+LEASE_KEY_FORMAT = 'lease-%s'
+LEASE_TIME = TIMEOUT # seconds, a resolution's deadline
+LEASE_POLL_INTERVAL = 0.25 # seconds
+
 # vim: sts=2:sw=2:ts=2:tw=85:cc=85
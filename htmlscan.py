@@ -0,0 +1,112 @@
+'''Reads just enough of a page to find its favicon declarations: the
+response is fed to an incremental parser chunk by chunk, stopping at the end
+of <head> or after MAX_HEAD_BYTES, instead of parsing the whole document.'''
+
+import HTMLParser
+import urlparse
+
+import globals
+
+from BeautifulSoup import BeautifulSoup
+
+class HeadScanner(HTMLParser.HTMLParser):
+  '''collects <link> tags and meta refresh directives from a page's head'''
+
+  def __init__(self):
+    HTMLParser.HTMLParser.__init__(self)
+    self.links = []
+    self.refreshes = []
+    self.done = False
+
+  def handle_starttag(self, tag, attrs):
+    if tag == 'link':
+      self.links.append(dict(attrs))
+    elif tag == 'meta':
+      attrs = dict(attrs)
+      if (attrs.get('http-equiv') or '').lower() == 'refresh':
+        self.refreshes.append(attrs.get('content') or '')
+    elif tag == 'body':
+      self.done = True
+
+  def handle_endtag(self, tag):
+    if tag == 'head':
+      self.done = True
+
+  def icon(self):
+    '''first <link> whose rel is an icon, as a dict of its attributes'''
+    for link in self.links:
+      if globals.RE_LINKTAG.search(link.get('rel') or ''):
+        return link
+    return None
+
+  def candidates(self, base):
+    '''every icon the head declares, hrefs resolved against base'''
+    found = []
+    for link in self.links:
+      rel = link.get('rel') or ''
+      href = (link.get('href') or '').strip()
+      if href and (globals.RE_LINKTAG.search(rel) or
+                   globals.RE_ICONREL.search(rel)):
+        sizes = (link.get('sizes') or '').lower().split()
+        found.append({'href': urlparse.urljoin(base, href),
+                      'rel': rel.lower(),
+                      'type': (link.get('type') or '').lower(),
+                      'scalable': 'any' in sizes,
+                      'sizes': [int(m.group(1)) for m in
+                                map(globals.RE_ICONSIZE.match, sizes) if m]})
+    return found
+
+def declaredSizes(candidate):
+  '''sizes a candidate declares, or what its rel usually means'''
+  if candidate['sizes']:
+    return candidate['sizes']
+  if 'apple-touch-icon' in candidate['rel']:
+    return [180]
+  return [globals.DEFAULT_ICON_SIZE]
+
+def score(candidate, size):
+  '''sort key, lower is better: an exact size, then the closest larger one
+  (it downscales cleanly), then scalable SVG, then the closest smaller one'''
+  if candidate['scalable'] or candidate['type'] == 'image/svg+xml' or \
+     urlparse.urlparse(candidate['href']).path.lower().endswith('.svg'):
+    return (2, 0)
+  best = min(declaredSizes(candidate), key=lambda s: (s < size, abs(s - size)))
+  if best == size:
+    return (0, 0)
+  return (1 if best > size else 3, abs(best - size))
+
+def rank(candidates, size):
+  '''candidates best first for an icon of size pixels, ties keep page order'''
+  order = sorted(enumerate(candidates),
+                 key=lambda (i, candidate): (score(candidate, size), i))
+  return [candidate for i, candidate in order]
+
+def soupScanner(page):
+  '''HeadScanner equivalent built with BeautifulSoup, for markup
+  HTMLParser gives up on'''
+  soup = BeautifulSoup(page)
+  scanner = HeadScanner()
+  scanner.links = [dict(link.attrs) for link in soup.findAll('link')]
+  scanner.refreshes = [meta.get('content', '') for meta in soup.findAll('meta')
+                       if meta.get('http-equiv', '').lower() == 'refresh']
+  scanner.done = True
+  return scanner
+
+def scan(response, maxBytes=globals.MAX_HEAD_BYTES, chunkSize=8192):
+  '''Reads response (any file-like object) until its head is over, and
+  returns a HeadScanner holding what was found'''
+  scanner = HeadScanner()
+  chunks, length = [], 0
+  while not scanner.done and length < maxBytes:
+    chunk = response.read(min(chunkSize, maxBytes - length))
+    if not chunk:
+      break
+    chunks.append(chunk)
+    length += len(chunk)
+    try:
+      scanner.feed(chunk)
+    except HTMLParser.HTMLParseError:
+      return soupScanner(''.join(chunks))
+  return scanner
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
@@ -0,0 +1,237 @@
+import errno
+import httplib
+import socket
+import threading
+import urllib2
+
+import globals
+
+from time import time
+
+class ConnectionPool(object):
+  '''keep-alive connections shared across threads, per (scheme, host).
+  At most maxPerHost connections to a host are checked out or idle at once;
+  idle ones are closed after idleTimeout seconds.'''
+
+  def __init__(self, maxPerHost, idleTimeout):
+    super(ConnectionPool, self).__init__()
+    self.maxPerHost = maxPerHost
+    self.idleTimeout = idleTimeout
+
+    self.lock = threading.Condition()
+    self.idle = dict() # key -> [(connection, last used)]
+    self.active = dict() # key -> connections checked out
+    self.lastSweep = time()
+
+    self.created = self.reused = self.evicted = self.discarded = 0
+    self.waits = self.exhausted = 0
+
+  def acquire(self, key, factory, timeout):
+    '''returns (connection, reused). Waits up to timeout seconds for a
+    connection to the host to free up when the host is at its limit'''
+    deadline = time() + timeout
+    with self.lock:
+      while True:
+        idle = self.idle.get(key)
+        while idle:
+          connection, used = idle.pop()
+          if time() - used < self.idleTimeout:
+            self.active[key] = self.active.get(key, 0) + 1
+            self.reused += 1
+            return connection, True
+          connection.close()
+          self.evicted += 1
+
+        if self.active.get(key, 0) < self.maxPerHost:
+          self.active[key] = self.active.get(key, 0) + 1
+          self.created += 1
+          break
+
+        remaining = deadline - time()
+        if remaining <= 0:
+          self.exhausted += 1
+          raise urllib2.URLError('connection pool for %s exhausted' % key[1])
+        self.waits += 1
+        self.lock.wait(remaining)
+
+    try:
+      return factory(), False
+    except:
+      # the slot was taken for a connection that never came to be
+      with self.lock:
+        self.active[key] -= 1
+        if not self.active[key]:
+          del self.active[key]
+        self.lock.notify()
+      raise
+
+  def release(self, key, connection, reusable):
+    with self.lock:
+      self.active[key] -= 1
+      if not self.active[key]:
+        del self.active[key]
+
+      if reusable:
+        self.idle.setdefault(key, []).append((connection, time()))
+      else:
+        connection.close()
+        self.discarded += 1
+
+      if time() - self.lastSweep > self.idleTimeout:
+        self._sweep()
+      self.lock.notify()
+
+  def _sweep(self):
+    '''closes connections idle for longer than idleTimeout'''
+    now = self.lastSweep = time()
+    for key, idle in self.idle.items():
+      fresh = [(c, used) for c, used in idle if now - used < self.idleTimeout]
+      for connection, used in idle:
+        if now - used >= self.idleTimeout:
+          connection.close()
+          self.evicted += 1
+      if fresh:
+        self.idle[key] = fresh
+      else:
+        del self.idle[key]
+
+  def stats(self):
+    with self.lock:
+      return {'hosts': len(set(self.idle) | set(self.active)),
+              'idle': sum(len(idle) for idle in self.idle.values()),
+              'active': sum(self.active.values()),
+              'created': self.created, 'reused': self.reused,
+              'evicted': self.evicted, 'discarded': self.discarded,
+              'waits': self.waits, 'exhausted': self.exhausted}
+
+def closedByPeer(e):
+  '''whether e is what using a keep-alive connection the server has
+  closed meanwhile raises'''
+  if isinstance(e, socket.timeout):
+    return False
+  if isinstance(e, httplib.BadStatusLine):
+    return True
+  return isinstance(e, socket.error) and \
+         e.errno in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+class DeadlineExceeded(socket.timeout):
+  pass
+
+class PooledSocket(object):
+  '''Just enough of a socket for socket._fileobject: reads the response body
+  and hands the connection back to the pool once the body is drained.
+  Closing before that discards the connection. With a deadline (see
+  concurrency.Deadline), no read waits past it.'''
+
+  def __init__(self, pool, key, connection, response, deadline=None,
+               timeout=None):
+    super(PooledSocket, self).__init__()
+    self.pool = pool
+    self.key = key
+    self.connection = connection
+    self.response = response
+    self.deadline = deadline
+    self.timeout = timeout
+
+  def recv(self, size):
+    if self.response is None:
+      return ''
+    if self.deadline:
+      remaining = self.deadline.remaining()
+      if remaining <= 0:
+        self.finish(False)
+        raise DeadlineExceeded('deadline passed reading response')
+      if self.connection.sock:
+        self.connection.sock.settimeout(min(remaining,
+                                            self.timeout or remaining))
+    try:
+      data = self.response.read(size)
+    except:
+      self.finish(False)
+      raise
+    if self.response.isclosed():
+      self.finish(not self.response.will_close)
+    return data
+
+  def close(self):
+    self.finish(False)
+
+  __del__ = close
+
+  def finish(self, reusable):
+    if self.response is None:
+      return
+    self.response = None
+    self.pool.release(self.key, self.connection, reusable)
+
+class PooledHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+  '''urllib2 handler sending requests over ConnectionPool connections
+  instead of a new connection per request'''
+
+  def __init__(self, pool, deadline=None):
+    urllib2.HTTPSHandler.__init__(self)
+    self.pool = pool
+    self.deadline = deadline
+
+  def http_open(self, req):
+    return self.pooledOpen(httplib.HTTPConnection, req)
+
+  def https_open(self, req):
+    if getattr(req, '_tunnel_host', None):
+      # CONNECT through a proxy, not worth pooling
+      return urllib2.HTTPSHandler.https_open(self, req)
+    return self.pooledOpen(httplib.HTTPSConnection, req)
+
+  def pooledOpen(self, connectionClass, req):
+    host = req.get_host()
+    if not host:
+      raise urllib2.URLError('no host given')
+
+    timeout = req.timeout
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+      timeout = socket.getdefaulttimeout()
+
+    headers = dict(req.unredirected_hdrs)
+    headers.update(dict((k, v) for k, v in req.headers.items()
+                        if k not in headers))
+    headers['Connection'] = 'keep-alive'
+    headers = dict((name.title(), value) for name, value in headers.items())
+
+    key = (req.get_type(), host)
+    for attempt in (1, 2):
+      if attempt == 2 and self.deadline:
+        # the retry only gets what is left of the deadline
+        remaining = self.deadline.remaining()
+        if remaining <= 0:
+          raise urllib2.URLError(DeadlineExceeded('deadline passed'))
+        timeout = min(timeout, remaining) if timeout else remaining
+      factory = lambda: connectionClass(host, timeout=timeout)
+      try:
+        connection, reused = self.pool.acquire(key, factory,
+            timeout or globals.CONNECTION_TIMEOUT)
+      except httplib.HTTPException as e:
+        # httplib.InvalidURL for a bad port, say
+        raise urllib2.URLError(e)
+      try:
+        if reused and connection.sock:
+          connection.sock.settimeout(timeout)
+        connection.request(req.get_method(), req.get_selector(), req.data,
+                           headers)
+        response = connection.getresponse()
+        break
+      except (socket.error, httplib.HTTPException) as e:
+        self.pool.release(key, connection, False)
+        # the server may have closed an idle keep-alive connection; a
+        # timeout means it is slow, not that the connection was stale
+        if reused and attempt == 1 and closedByPeer(e):
+          continue
+        raise urllib2.URLError(e)
+
+    fp = socket._fileobject(PooledSocket(self.pool, key, connection, response,
+                                         self.deadline, timeout), close=True)
+    resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+    resp.code = response.status
+    resp.msg = response.reason
+    return resp
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
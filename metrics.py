@@ -0,0 +1,203 @@
+import bisect
+import cherrypy
+import re
+import threading
+
+from logging import DEBUG, ERROR
+from random import random
+from time import sleep, time
+
+class Counters(object):
+  '''Counters bumped in-process, in a dict per thread so incr takes no lock
+  and does no network I/O. A background thread adds what was counted since
+  its last pass to memcache keys (keyFormat % name) every interval seconds;
+  totals() is memcache's value plus whatever this process hasn't flushed.'''
+
+  def __init__(self, mc, interval, keyFormat='counter-%s'):
+    super(Counters, self).__init__()
+    self.mc = mc
+    self.interval = interval
+    self.keyFormat = keyFormat
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.flushLock = threading.Lock()
+    self.threads = [] # every thread's counts, only ever grows
+    self.flushed = dict()
+    self.flusher = None
+
+  def _counts(self):
+    counts = getattr(self.local, 'counts', None)
+    if counts is None:
+      counts = self.local.counts = dict()
+      with self.lock:
+        self.threads.append(counts)
+        if not self.flusher:
+          self.flusher = threading.Thread(target=self._run, name='counters')
+          self.flusher.daemon = True
+          self.flusher.start()
+    return counts
+
+  def incr(self, name, delta=1):
+    counts = self._counts()
+    counts[name] = counts.get(name, 0) + delta
+
+  def counted(self):
+    '''what this process counted since it started, by name'''
+    with self.lock:
+      threads = list(self.threads)
+    totals = dict()
+    for counts in threads:
+      # items() copies atomically, the owning thread may be adding keys
+      for name, value in counts.items():
+        totals[name] = totals.get(name, 0) + value
+    return totals
+
+  def flush(self):
+    with self.flushLock:
+      for name, value in self.counted().items():
+        delta = value - self.flushed.get(name, 0)
+        if not delta:
+          continue
+        key = self.keyFormat % name
+        if self.mc.incr(key, delta) is None and \
+           not self.mc.add(key, str(delta)) and \
+           self.mc.incr(key, delta) is None:
+          # memcache unreachable, the delta goes with the next flush
+          continue
+        self.flushed[name] = value
+
+  def _run(self):
+    while True:
+      sleep(self.interval)
+      try:
+        self.flush()
+      except Exception as e:
+        cherrypy.log('Counter flush failed: %s' % e, severity=ERROR)
+
+  def totals(self, names=()):
+    '''every process's flushed counts plus this one's unflushed ones, for
+    names and whatever this process has counted'''
+    with self.flushLock:
+      counted = self.counted()
+      names = set(names) | set(counted)
+      stored = self.mc.get_multi([self.keyFormat % name for name in names])
+      return dict((name, int(stored.get(self.keyFormat % name) or 0) +
+                         counted.get(name, 0) - self.flushed.get(name, 0))
+                  for name in names)
+
+class Histogram(object):
+  '''Fixed-bucket histogram: counts[i] holds the observations no greater
+  than buckets[i], the last count the ones above every bucket'''
+
+  def __init__(self, buckets):
+    super(Histogram, self).__init__()
+    self.buckets = list(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+    self.lock = threading.Lock()
+
+  def observe(self, value):
+    i = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      self.counts[i] += 1
+      self.sum += value
+
+  def snapshot(self):
+    '''(counts, sum)'''
+    with self.lock:
+      return list(self.counts), self.sum
+
+class NoTimer(object):
+  '''what Stages.timed hands out for calls left out of the sample'''
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, exc, traceback):
+    return False
+
+NO_TIMER = NoTimer()
+
+class Timer(object):
+
+  def __init__(self, stages, stage, label):
+    super(Timer, self).__init__()
+    self.stages = stages
+    self.stage = stage
+    self.label = label
+
+  def __enter__(self):
+    self.started = time()
+    return self
+
+  def __exit__(self, excType, exc, traceback):
+    elapsed = time() - self.started
+    self.stages.observe(self.stage, elapsed)
+    if self.label:
+      cherrypy.log('TRACE %s %s: %.1fms%s' % (self.stage, self.label,
+                   elapsed * 1000, ' (%s)' % excType.__name__ if excType else ''),
+                   severity=DEBUG)
+    return False
+
+class Stages(object):
+  '''Latency histograms per pipeline stage. Each timed() block is sampled
+  with probability sampleRate; at 0 timing costs one comparison.'''
+
+  def __init__(self, buckets, sampleRate):
+    super(Stages, self).__init__()
+    self.buckets = buckets
+    self.sampleRate = sampleRate
+    self.lock = threading.Lock()
+    self.histograms = dict()
+
+  def timed(self, stage, label=None):
+    '''context manager timing its block as stage, traced in the debug log
+    under label when one is given'''
+    if not self.sampleRate or random() >= self.sampleRate:
+      return NO_TIMER
+    return Timer(self, stage, label)
+
+  def observe(self, stage, seconds):
+    histogram = self.histograms.get(stage)
+    if histogram is None:
+      with self.lock:
+        histogram = self.histograms.setdefault(stage, Histogram(self.buckets))
+    histogram.observe(seconds)
+
+def metricName(name):
+  return re.sub('[^a-zA-Z0-9_]', '_', name)
+
+def histogramLines(metric, stages):
+  lines = ['# TYPE %s histogram' % metric]
+  for stage, histogram in sorted(stages.histograms.items()):
+    counts, total = histogram.snapshot()
+    cumulative = 0
+    for bucket, count in zip(histogram.buckets + ['+Inf'], counts):
+      cumulative += count
+      lines.append('%s_bucket{stage="%s",le="%s"} %d' % \
+                   (metric, stage, bucket, cumulative))
+    lines.append('%s_sum{stage="%s"} %f' % (metric, stage, total))
+    lines.append('%s_count{stage="%s"} %d' % (metric, stage, cumulative))
+  return lines
+
+def prometheus(stages, counters, overruns=None, gauges=None,
+               prefix='favicon'):
+  '''stage histograms, deadline overruns by stage, this process's counters
+  and gauges ({name: current value}) in the Prometheus text exposition
+  format'''
+  lines = histogramLines('%s_stage_seconds' % prefix, stages)
+  if overruns:
+    lines.extend(histogramLines('%s_overrun_seconds' % prefix, overruns))
+
+  for name, value in sorted((gauges or dict()).items()):
+    metric = '%s_%s' % (prefix, metricName(name))
+    lines.append('# TYPE %s gauge' % metric)
+    lines.append('%s %d' % (metric, value))
+
+  for name, value in sorted(counters.counted().items()):
+    metric = '%s_%s_total' % (prefix, metricName(name))
+    lines.append('# TYPE %s counter' % metric)
+    lines.append('%s %d' % (metric, value))
+  return '\n'.join(lines) + '\n'
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
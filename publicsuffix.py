@@ -0,0 +1,134 @@
+'''Public suffix lookups, for telling a site's registrable domain from the
+suffixes anyone can register under (com, co.uk, blogspot.com).
+
+The rules come from public_suffix_list.dat, a copy of
+https://publicsuffix.org/list/public_suffix_list.dat bundled with the
+service; refresh it from there now and then. They are compiled into a trie
+of labels, last label first, once per process on first use, and lookups are
+memoized per host.
+
+canonicalHost() is what cache keys are built from: one name per site for
+every way of spelling its url.'''
+
+import os
+import re
+import threading
+
+import globals
+
+RE_IPV4 = re.compile(r'^\d+(\.\d+){3}$')
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+class PublicSuffixList(object):
+  '''Trie of public suffix rules. Each node is a dict of child labels; ''
+  marks the end of a rule, '!' an exception to a wildcard above it.'''
+
+  def __init__(self, lines, memoSize=100000):
+    super(PublicSuffixList, self).__init__()
+    self.root = dict()
+    self.memoSize = memoSize
+    self.memo = dict() # host -> number of labels in its public suffix
+    for line in lines:
+      rule = line.strip().split(None, 1)[0] if line.strip() else ''
+      if rule and not rule.startswith('//'):
+        self.add(rule.decode('utf-8'))
+
+  @classmethod
+  def load(cls, path):
+    with open(path) as f:
+      return cls(f)
+
+  def add(self, rule):
+    exception = rule.startswith('!')
+    labels = rule.lstrip('!').lower().split('.')
+    try:
+      # urls carry internationalized names as punycode
+      labels = [label.encode('idna') if label != '*' else '*'
+                for label in labels]
+    except UnicodeError:
+      return
+    node = self.root
+    for label in reversed(labels):
+      node = node.setdefault(label, dict())
+    node['!' if exception else ''] = True
+
+  def suffixLength(self, host):
+    '''number of labels in host's public suffix, at least one'''
+    length = self.memo.get(host)
+    if length is not None:
+      return length
+
+    length, node = 1, self.root
+    for i, label in enumerate(reversed(host.split('.'))):
+      child, wildcard = node.get(label), node.get('*')
+      if child is not None and '!' in child:
+        length = i
+        break
+      if (child is not None and '' in child) or \
+         (wildcard is not None and '' in wildcard):
+        length = i + 1
+      node = child if child is not None else wildcard
+      if node is None:
+        break
+
+    if len(self.memo) >= self.memoSize:
+      self.memo.clear()
+    self.memo[host] = length
+    return length
+
+  def publicSuffix(self, host):
+    return '.'.join(host.split('.')[-self.suffixLength(host):])
+
+  def registrableDomain(self, host):
+    '''the public suffix and one label before it: 'bbc.co.uk' for
+    'news.bbc.co.uk'. None for public suffixes themselves and IP addresses.'''
+    if isIP(host):
+      return None
+    labels = host.split('.')
+    length = self.suffixLength(host)
+    if len(labels) <= length:
+      return None
+    return '.'.join(labels[-length - 1:])
+
+def isIP(host):
+  return bool(RE_IPV4.match(host)) or ':' in host or host.startswith('[')
+
+_default = None
+_lock = threading.Lock()
+
+def default():
+  '''the bundled list, compiled on first use'''
+  global _default
+  if _default is None:
+    with _lock:
+      if _default is None:
+        _default = PublicSuffixList.load(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            globals.PUBLIC_SUFFIX_LIST))
+  return _default
+
+def registrableDomain(host):
+  return default().registrableDomain(host)
+
+def splitPort(netloc):
+  '''(host, port or None) for netloc, without any user:password@'''
+  hostport = netloc.rsplit('@', 1)[-1]
+  host, port = hostport, None
+  if ':' in hostport and not hostport.endswith(']'):
+    host, port = hostport.rsplit(':', 1)
+  return host, port
+
+def canonicalHost(scheme, netloc):
+  '''Lowercases netloc and drops the scheme's default port, a trailing dot
+  and a leading 'www.' when what remains is still a registrable domain:
+  'http://WWW.Example.com:80' and 'https://example.com' are one site. Other
+  subdomains and ports are kept, they often serve a different icon.'''
+  host, port = splitPort(netloc.lower())
+  host = host.rstrip('.')
+  if port and port.isdigit() and int(port) == DEFAULT_PORTS.get(scheme.lower()):
+    port = None
+  if host.startswith('www.') and registrableDomain(host[4:]):
+    host = host[4:]
+  return '%s:%s' % (host, port) if port else host
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
@@ -0,0 +1,85 @@
+'''Icon renditions: an icon brought to one pixel size, as PNG.
+
+PNG images of the right size inside multi-image ICOs are extracted as is.
+Everything else is resampled with PIL when it is installed; without it
+only those exact ICO entries can be served, and callers fall back to the
+original bytes.'''
+
+import struct
+import StringIO
+
+import globals
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+def icoEntries(data):
+  '''[(width, height, image bytes)] from an ICO's directory'''
+  if len(data) < 6:
+    return []
+  reserved, kind, count = struct.unpack('<HHH', data[:6])
+  entries = []
+  for i in xrange(count):
+    offset = 6 + 16 * i
+    if len(data) < offset + 16:
+      break
+    width, height, colors, reserved, planes, bpp, length, start = \
+        struct.unpack('<BBBBHHII', data[offset:offset + 16])
+    entries.append((width or 256, height or 256, data[start:start + length]))
+  return entries
+
+def extract(data, size):
+  '''the PNG entry of exactly size pixels in an ICO, or None'''
+  for width, height, image in icoEntries(data):
+    if width == size and height == size and image.startswith(PNG_SIGNATURE):
+      return image
+  return None
+
+def resample(data, size):
+  '''data scaled to size x size and encoded as PNG, None if PIL is missing,
+  can't read it or it is too large to decode'''
+  if not Image:
+    return None
+  try:
+    # only reads the header, the pixels are decoded by convert()
+    image = Image.open(StringIO.StringIO(data))
+    width, height = image.size
+    if width * height > globals.MAX_RENDITION_PIXELS:
+      return None
+    if image.format == 'ICO':
+      # pick the smallest entry that is at least size, not the largest
+      sizes = sorted(image.info.get('sizes', []))
+      fitting = [s for s in sizes if s[0] >= size] or sizes[-1:]
+      if fitting:
+        image.size = fitting[0]
+    image = image.convert('RGBA')
+    if image.size != (size, size):
+      image = image.resize((size, size), Image.ANTIALIAS)
+    output = StringIO.StringIO()
+    image.save(output, 'PNG', optimize=True)
+    return output.getvalue()
+  except Exception:
+    # whatever the origin sent, decoding it must not fail the request:
+    # besides IOError PIL raises DecompressionBombError, struct.error...
+    return None
+
+def pngSize(data):
+  '''(width, height) from a PNG's IHDR chunk'''
+  return struct.unpack('>II', data[16:24])
+
+def render(data, type, size):
+  '''PNG bytes of the icon at size pixels, or None'''
+  if data.startswith(PNG_SIGNATURE) and len(data) >= 24 and \
+     pngSize(data) == (size, size):
+    return data
+  if type == 'image/x-icon':
+    extracted = extract(data, size)
+    if extracted:
+      return extracted
+  return resample(data, size)
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
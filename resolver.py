@@ -0,0 +1,1175 @@
+'''Favicon resolution engine: cache lookups, the fallback chain of page and
+root probes, and icon validation. Knows nothing about the HTTP request it is
+serving; PrintFavicon in favicon.py is a thin CherryPy adapter on top.'''
+
+import StringIO
+import cPickle
+import cherrypy
+import functools
+import gzip
+import hashlib
+import os
+import re
+import socket
+import subprocess
+import urllib2
+import urlparse
+
+import cache
+import concurrency
+import globals
+import htmlscan
+import httppool
+import metrics
+import publicsuffix
+import rendition
+import ring
+import sniff
+import store
+
+from logging import DEBUG, INFO, WARN, ERROR
+from time import sleep, time
+
+# helper methods
+
+def timeout_handler(signum, frame):
+  raise TimeoutError()
+
+def libmagic(string):
+  '''Figures out the mimetype in-process from magic bytes, only forking
+  `file` for signatures sniff doesn't know'''
+  mime = sniff.sniff(string)
+  if mime:
+    return mime
+  return filecommand(string)
+
+def filecommand(string):
+  '''Example out= '/dev/stdin: image/x-ico; charset=binary'
+  mime = image/x-ico(n)
+  Browsers want '''
+  process = subprocess.Popen(globals.FILECOMMAND,
+            stdin=subprocess.PIPE,stdout=subprocess.PIPE, close_fds=True)
+  out, err = process.communicate(input=string)
+  file, mime, charset = filter(lambda string: string, re.split("[\s:;]",out))
+
+  if mime in "image/x-ico":
+    mime = "image/x-icon"
+  return mime
+
+def renderAll(icon, sizes):
+  '''{size: Icon} PNG renditions of icon, skipping sizes it can't provide'''
+  renditions = dict()
+  for size in sizes:
+    data = rendition.render(icon.data, icon.type, size)
+    if data:
+      renditions[size] = Icon(data=data, location=icon.location,
+                              type='image/png', validated=icon.validated)
+  return renditions
+
+def stage(name):
+  '''decorator timing a Resolver method as pipeline stage name, traced under
+  its first argument when that's a url. Calls that start before the
+  deadline among their arguments and end after it count as overruns.'''
+  def decorator(method):
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+      label = args and isinstance(args[0], basestring) and args[0] or None
+      deadlines = [arg for arg in args
+                   if isinstance(arg, concurrency.Deadline)]
+      inTime = deadlines and not deadlines[0].expired()
+      try:
+        with self.stages.timed(name, label):
+          return method(self, *args, **kwargs)
+      finally:
+        if inTime and deadlines[0].expired():
+          self.counters.incr('overrun-%s' % name)
+          self.overruns.observe(name, -deadlines[0].remaining())
+    return timed
+  return decorator
+
+def gunzip(stream):
+  '''Don't use for even moderately big files'''
+  f = StringIO.StringIO(stream)
+  output = gzip.GzipFile(fileobj=f).read()
+  f.close()
+  return output
+
+# classes
+
+class Icon(object):
+  '''container for storing favicon'''
+  def __init__(self, data=None, location=None, type=None, validated=None,
+               etag=None, lastModified=None):
+    super(Icon, self).__init__()
+    self.data = data
+    self.location = location
+    self.type = type
+    self.validated = validated
+    # validators the origin sent, for conditional refreshes
+    self.etag = etag
+    self.lastModified = lastModified
+    self._digest = None
+    # size -> Icon, computed when validated, not part of the cache entry
+    self.renditions = None
+
+  def length(self):
+    return len(self.data) + \
+           sum(len(r.data) for r in (self.renditions or dict()).values())
+
+  def digest(self):
+    '''md5 of the icon data, our own ETag for it'''
+    if not self._digest:
+      self._digest = hashlib.md5(self.data).hexdigest()
+    return self._digest
+
+  def toCache(self):
+    '''plain dict, so cached entries don't depend on this module's path'''
+    return {'data': self.data, 'location': self.location, 'type': self.type,
+            'validated': self.validated, 'etag': self.etag,
+            'last_modified': self.lastModified}
+
+  @classmethod
+  def fromCache(cls, entry):
+    return cls(data=entry['data'], location=entry['location'],
+               type=entry['type'], validated=entry['validated'],
+               etag=entry.get('etag'), lastModified=entry.get('last_modified'))
+
+class TimeoutError(Exception):
+
+  def __str__(self):
+    return repr(TimeoutError)
+
+class MalformedURLError(ValueError):
+  pass
+
+class Overloaded(Exception):
+  '''resolution refused, too many are in flight already'''
+  pass
+
+class ProbeSkipped(IOError):
+  '''fetch not attempted, the url or its host failed recently'''
+  pass
+
+def failureKind(e):
+  '''classifies an exception raised by Resolver.open for the negative cache'''
+  if isinstance(e, TimeoutError) or isinstance(e, socket.timeout):
+    return 'timeout'
+  if isinstance(e, urllib2.HTTPError):
+    return 'http5xx' if e.code >= 500 else 'http4xx'
+  if isinstance(e, urllib2.URLError):
+    if isinstance(e.reason, socket.timeout):
+      return 'timeout'
+    if isinstance(e.reason, socket.gaierror):
+      return 'dns'
+  return 'connect'
+
+class BaseHandler(object):
+  '''decodes urls using a regex'''
+
+  def __init__(self):
+    super(BaseHandler, self).__init__()
+    self.re = globals.RE_URLDECODE
+
+  def htc(self, m):
+    return chr(int(m.group(1), 16))
+
+  def urldecode(self, url):
+    return self.re.sub(self.htc, url)
+
+class Resolver(BaseHandler):
+  '''Finds the favicon for a url. Settings are read from config, a dict such
+  as cherrypy.config; mc may be passed in instead of built from config.'''
+
+  def __init__(self, config, mc=None):
+    super(Resolver, self).__init__()
+
+    self.stages = metrics.Stages(globals.LATENCY_BUCKETS,
+        config.get('metrics.sample_rate', globals.METRICS_SAMPLE_RATE))
+    # rare enough to keep them all
+    self.overruns = metrics.Stages(globals.LATENCY_BUCKETS, 1.0)
+    self.httpPool = httppool.ConnectionPool(
+        config.get('pool.max_per_host', globals.POOL_MAX_PER_HOST),
+        config.get('pool.idle_timeout', globals.POOL_IDLE_TIMEOUT))
+
+    with open(config.get('favicon.default_icon') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        globals.DEFAULT_FAVICON_FILE), 'rb') as f:
+      default_icon_data = f.read()
+
+    self.default_icon = Icon(data=default_icon_data,
+        location=globals.DEFAULT_FAVICON_LOC, type='image/png')
+    self.default_icon.renditions = renderAll(self.default_icon,
+                                             globals.RENDITION_SIZES)
+    self.mc = mc or ring.ShardedClient(config.get('memcache.nodes') or
+      ['%(memcache.host)s:%(memcache.port)d' % config],
+      deadRetry=config.get('memcache.dead_retry', globals.MC_DEAD_RETRY),
+      debug=2)
+    self.local = cache.LRUCache(
+        config.get('cache.local_bytes', globals.LOCAL_CACHE_BYTES),
+        globals.LOCAL_CACHE_TIME, sizeof=lambda icon: icon.length())
+    # on-disk tier between self.local and self.mc, off unless configured
+    self.store = None
+    if config.get('store.path'):
+      self.store = store.SegmentStore(config['store.path'],
+          config.get('store.max_bytes', globals.STORE_MAX_BYTES))
+    self.fanout = config.get('resolver.fanout', globals.PROBE_FANOUT)
+    # own pool: probes waiting on probePool workers could starve it
+    self.prefetchPool = concurrency.WorkerPool(
+        config.get('resolver.prefetch_threads', globals.PREFETCH_THREADS),
+        name='prefetch')
+    self.probePool = concurrency.WorkerPool(
+        config.get('resolver.probe_threads', globals.PROBE_THREADS),
+        name='probe')
+    # whole resolutions run here; kept apart from probePool, whose workers
+    # they wait on
+    self.resolvePool = concurrency.WorkerPool(
+        config.get('resolver.threads', globals.RESOLVER_THREADS),
+        name='resolve')
+
+    self.negative = cache.NegativeCache(self.mc, globals.NEGATIVE_TTL,
+                                        globals.NEGATIVE_KEY_FORMAT)
+    self.backoff = cache.HostBackoff(globals.BACKOFF_BASE, globals.BACKOFF_MAX)
+    self.flights = concurrency.SingleFlight()
+    self.admission = concurrency.Admission(
+        config.get('resolver.max_resolutions', globals.MAX_RESOLUTIONS))
+    self.refreshQueue = concurrency.RefreshQueue(self.refresh,
+        config.get('refresh.threads', globals.REFRESH_THREADS),
+        config.get('refresh.max_depth', globals.REFRESH_MAX_DEPTH))
+    self.leaseWaits = self.leaseHits = 0
+    self.notModified = 0
+
+    self.counters = metrics.Counters(self.mc,
+        config.get('metrics.flush_interval', globals.COUNTER_FLUSH_INTERVAL))
+
+  @stage('open')
+  def open(self, url, deadline, headers=None):
+    '''GETs url within deadline: connecting, the response headers and every
+    read of the body are cut short when it runs out. Raises TimeoutError
+    when the deadline, rather than the origin, is why it failed.'''
+    remaining = deadline.remaining()
+    if remaining <= 0:
+      raise TimeoutError(deadline.elapsed())
+
+    if not headers:
+      headers = dict()
+    headers.update(globals.HEADERS)
+
+    opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(),
+        httppool.PooledHandler(self.httpPool, deadline))
+    timeout = min(globals.CONNECTION_TIMEOUT, remaining)
+    try:
+      result = opener.open(urllib2.Request(url, headers=headers),
+                           timeout=timeout)
+    except IOError as e:
+      if timeout < globals.CONNECTION_TIMEOUT and failureKind(e) == 'timeout':
+        raise TimeoutError(deadline.elapsed())
+      raise
+    cherrypy.log('URL:%s =redirect=> %s' % (url, result.url), severity=DEBUG)
+
+    return result
+
+  def probe(self, url, deadline, headers=None):
+    '''self.open for fallback steps: skips urls that failed recently and
+    hosts backing off, and remembers new failures'''
+    host = urlparse.urlparse(url).netloc
+    if self.backoff.blocked(host):
+      raise ProbeSkipped('%s is backing off' % host)
+    kind = self.negative.get(url)
+    if kind:
+      raise ProbeSkipped('%s failed recently (%s)' % (url, kind))
+
+    try:
+      result = self.open(url, deadline, headers=headers)
+    except TimeoutError:
+      # out of time, not the origin's fault
+      raise
+    except IOError as e:
+      self.recordFailure(url, failureKind(e))
+      raise
+    self.backoff.success(host)
+    return result
+
+  def recordFailure(self, url, kind):
+    cherrypy.log('URL:%s, remembering failure: %s' % (url, kind),
+                 severity=DEBUG)
+    self.negative.add(url, kind)
+    self.counters.incr('failures-%s' % kind)
+    if kind in ('timeout', 'connect', 'dns', 'http5xx'):
+      self.backoff.failure(urlparse.urlparse(url).netloc)
+
+  @stage('followRedirect')
+  def followRedirect(self, domain, skipCache, deadline):
+    '''Where domain's root page redirects to, as (path, domain, page). page
+    is the redirected page's response when it had to be fetched to find
+    out, so it isn't fetched twice, and None when the redirect was
+    cached. The target is cached for REDIRECT_CACHE_TIME either way.'''
+    key = globals.REDIRECT_KEY_FORMAT % domain
+    location = not skipCache and self.mc.get(key)
+    if location:
+      return self.parse(location) + (None,)
+
+    page = self.probe(domain, deadline)
+    location = str(page.geturl())
+    if location.rstrip('/') != domain:
+      cherrypy.log('URL:%s, redirected to: %s' % (domain, location),
+                   severity=WARN)
+    self.mc.set(key, location, time=globals.REDIRECT_CACHE_TIME)
+    return self.parse(location) + (page,)
+
+  @stage('validateIcon')
+  def validateIcon(self, iconResponse):
+    '''Figures out mimetype and whether to gunzip.
+    Thrown through a bunch of validation tests.
+    No real reason to be an instance method.
+    returns Icon or None if error'''
+    #too many try/catch blocks here?
+    url = iconResponse.url
+    code = iconResponse.getcode()
+
+    if code != 200:
+      cherrypy.log('URL:%s Unsuccessful response: %s' % (url, code), severity=WARN)
+
+    icon = iconResponse.read()
+    length = len(icon)
+
+    if not length:
+      cherrypy.log('URL:%s Content-Length=0' % url, severity=ERROR)
+      return None
+
+    try:
+      with self.stages.timed('libmagic'):
+        contentType = libmagic(icon)
+    except (OSError, ValueError) as e:
+      cherrypy.log('URL:%s Unexpected OSError: %s' % (url, e), severity=ERROR)
+      return None
+
+    if 'gzip' in contentType:
+      cherrypy.log('URL:%s Type is gzip, unpacking...' % url, severity=WARN)
+      icon = gunzip(icon)
+      try:
+        contentType = libmagic(icon)
+      except (OSError, ValueError) as e:
+        cherrypy.log('URL:%s Unexpected OSError: %s' % (url, e), severity=ERROR)
+
+    if contentType in globals.ICON_MIMETYPE_BLACKLIST:
+      cherrypy.log('URL:%s Content-Type:%s blacklisted' % (url, contentType),
+          severity=ERROR)
+      return None
+
+    if length < globals.MIN_ICON_LENGTH or length > globals.MAX_ICON_LENGTH:
+      cherrypy.log('URL:%s Warning: favicon size:%d out of bounds' % \
+          (url, length), severity=WARN)
+
+    headers = iconResponse.info()
+    validIcon = Icon(data=icon, type=contentType, validated=time(),
+                     etag=headers.getheader('ETag'),
+                     lastModified=headers.getheader('Last-Modified'))
+    validIcon.renditions = renderAll(validIcon, globals.RENDITION_SIZES)
+    return validIcon
+
+  @stage('iconAtRoot')
+  def iconAtRoot(self, domain, deadline):
+    '''check for icon at [domain]/favicon.ico'''
+    cherrypy.log('URL:%s/favicon.ico Searching...' % domain, severity=DEBUG)
+    path = urlparse.urljoin(domain, '/favicon.ico')
+    rootIcon = None
+    try:
+      result = self.probe(path, deadline)
+      rootIcon = self.validateIcon(result)
+    except (TimeoutError, IOError, ValueError) as e:
+      cherrypy.log('URL:%s/favicon.ico Error %s' % (domain, e), severity=ERROR)
+      return None
+
+    if rootIcon:
+      cherrypy.log('URL:%s/favicon.ico Found' % domain, severity=INFO)
+      rootIcon.location = path
+      return rootIcon
+    self.recordFailure(path, 'invalid')
+    return None
+
+  # Icon specified in page?
+  @stage('iconInPage')
+  def iconInPage(self, domain, path, skipCache, deadline, refresh=True,
+                 size=globals.DEFAULT_ICON_SIZE):
+    '''check for icon in <link rel="icon"> tags, trying the declared icons
+    best first for size. Follow http-equiv meta-refreshes if necessary'''
+    cherrypy.log('URL:%s searching for <link> tag' % path, severity=DEBUG)
+
+    # declarations seen on an earlier visit spare fetching the page
+    candidates = not skipCache and self.mc.get(self.candidatesKey(path))
+    if candidates:
+      pageIcon = self.iconFromCandidates(domain, candidates, deadline, size)
+      if pageIcon:
+        return pageIcon
+
+    try:
+      return self.iconInResponse(domain, path, self.probe(path, deadline),
+                                 skipCache, deadline, refresh=refresh,
+                                 size=size)
+    except (TimeoutError, IOError) as e:
+      cherrypy.log('URL:%s, Error: %s' % (path, e), severity=ERROR)
+      return None
+
+  def iconInResponse(self, domain, path, rootDomainPageResult, skipCache,
+                     deadline, refresh=True, size=globals.DEFAULT_ICON_SIZE):
+    '''iconInPage for a page that has already been fetched'''
+    try:
+      if rootDomainPageResult.getcode() == 200:
+        with self.stages.timed('headScan'):
+          pageHead = htmlscan.scan(rootDomainPageResult)
+        rootDomainPageResult.close()
+        candidates = pageHead.candidates(path)
+
+        if candidates:
+          cherrypy.log('URL:%s, found %d embedded favicon links' % \
+                       (domain, len(candidates)), severity=DEBUG)
+          self.mc.set(self.candidatesKey(path), candidates,
+                      time=globals.ICON_SOFT_TIME)
+
+          cookies = rootDomainPageResult.headers.getheaders("Set-Cookie")
+          headers = None
+          if cookies:
+            headers = {'Cookie': ';'.join(cookies)}
+
+          return self.iconFromCandidates(domain, candidates, deadline, size,
+                                         headers=headers)
+
+        else:
+          if refresh:
+            for content in pageHead.refreshes:
+              match = globals.RE_METAREFRESH.search(content)
+
+              if match:
+                refreshPath = urlparse.urljoin(rootDomainPageResult.geturl(),
+                                      match.group(1)).strip()
+
+                cherrypy.log('URL:%s, refresh directive: %s' % \
+                             (domain, refreshPath),
+                             severity=WARN)
+
+                icon = self.iconInPage(domain,
+                                       refreshPath,
+                                       skipCache,
+                                       deadline,
+                                       refresh=False,
+                                       size=size) or \
+                       self.iconAtRoot(refreshPath,
+                                       deadline)
+                return icon
+
+          cherrypy.log('URL:%s no <link> tag found' % path, severity=DEBUG)
+
+      else:
+        cherrypy.log('URL:%s, unsuccessful response %s' % \
+                     (path, rootDomainPageResult.getcode()), severity=DEBUG)
+        return None
+
+    except (TimeoutError, IOError) as e:
+      cherrypy.log('URL:%s, Error: %s' % (path, e), severity=ERROR)
+      return None
+
+  def candidatesKey(self, path):
+    return globals.CANDIDATES_KEY_FORMAT % hashlib.md5(str(path)).hexdigest()
+
+  def iconFromCandidates(self, domain, candidates, deadline, size,
+                         headers=None):
+    '''Fetches the best of the declared icons, the next best one already
+    being fetched in the background in case it fails validation. Renditions
+    larger than size are scaled from the largest icon declared, fetched
+    alongside.'''
+    ranked = htmlscan.rank(candidates, size)[:globals.MAX_CANDIDATES]
+    largest = htmlscan.rank(candidates, max(globals.RENDITION_SIZES))[0]
+    source = None
+    if max(htmlscan.declaredSizes(largest)) > \
+       max(htmlscan.declaredSizes(ranked[0])):
+      source = self.prefetchPool.submit(self.fetchIcon, largest['href'],
+                                        deadline, headers)
+    prefetch = None
+    for i, candidate in enumerate(ranked):
+      current = prefetch
+      prefetch = None
+      if i + 1 < len(ranked):
+        prefetch = self.prefetchPool.submit(self.fetchIcon,
+            ranked[i + 1]['href'], deadline, headers)
+
+      if current:
+        pageIcon = current.result(max(0, deadline.remaining()))
+      else:
+        pageIcon = self.fetchIcon(candidate['href'], deadline, headers)
+
+      if pageIcon:
+        if prefetch:
+          prefetch.cancel()
+        cherrypy.log('URL:%s, found favicon at %s' % \
+                     (domain, candidate['href']), severity=DEBUG)
+        pageIcon.location = candidate['href']
+        sourceIcon = source and source.result(max(0, deadline.remaining()))
+        if sourceIcon:
+          sourceIcon.location = largest['href']
+          pageIcon.renditions.update(renderAll(sourceIcon,
+              [s for s in globals.RENDITION_SIZES if s > size]))
+        return pageIcon
+    if source:
+      source.cancel()
+    return None
+
+  def fetchIcon(self, url, deadline, headers=None):
+    '''returns the validated Icon at url, or None'''
+    try:
+      icon = self.validateIcon(self.probe(url, deadline, headers=headers))
+    except (TimeoutError, IOError, ValueError) as e:
+      cherrypy.log('URL:%s, Error: %s' % (url, e), severity=ERROR)
+      return None
+    if not icon:
+      self.recordFailure(url, 'invalid')
+    return icon
+
+  @stage('cacheIcon')
+  def cacheIcon(self, domain, location, icon=None, ttl=globals.MC_CACHE_TIME):
+    '''Used to cache to self.mc'''
+    key = globals.KEY_FORMAT % self.cacheKey(domain)
+    cherrypy.log('key=%s, value=%s' % (key, location), severity=DEBUG)
+
+    ret = self.mc.set(key, str(location), time = ttl)
+    if not ret:
+      cherrypy.log('key=%s, value=%s : could not cache', severity=ERROR)
+
+    if self.store:
+      # the disk tier is an optimization, failing it never fails a request
+      try:
+        self.store.set(self.cacheKey(domain), icon.toCache() if icon else
+                       {'location': str(location)}, ttl)
+      except (EnvironmentError, ValueError) as e:
+        cherrypy.log('key=%s : could not store, Error: %s' % (key, e),
+                     severity=ERROR)
+
+    if icon:
+      self.local.set(self.cacheKey(domain), icon)
+      self.cacheIconData(domain, icon)
+      if icon.renditions:
+        self.mc.set_multi(dict((self.renditionKey(location, size), r.toCache())
+                               for size, r in icon.renditions.items()),
+                          time=ttl)
+
+  def cacheIconData(self, domain, icon):
+    '''Caches the validated icon itself, so hits need no trip to the origin.
+    The entry under <key> holds the metadata, the bytes are stored as plain
+    strings in chunks under <key>-<n>: python-memcached pickles dicts at
+    protocol 0, which nearly triples binary data.'''
+    key = globals.ICON_KEY_FORMAT % self.cacheKey(domain)
+    entry = icon.toCache()
+    data = entry.pop('data')
+
+    chunks = [data[i:i + globals.MC_CHUNK_SIZE]
+              for i in xrange(0, len(data), globals.MC_CHUNK_SIZE)]
+    entry['chunks'] = len(chunks)
+    items = dict(('%s-%d' % (key, i), chunk)
+                 for i, chunk in enumerate(chunks))
+    items[key] = entry
+
+    failed = self.mc.set_multi(items, time=globals.MC_CACHE_TIME)
+    if failed:
+      cherrypy.log('key=%s : could not cache icon data (%d bytes)' % \
+                   (key, len(data)), severity=ERROR)
+
+  def cachedIconData(self, domain):
+    '''returns the Icon cached by cacheIconData, or None'''
+    key = globals.ICON_KEY_FORMAT % self.cacheKey(domain)
+    entry = self.mc.get(key)
+    if not entry:
+      return None
+    keys = self.chunkKeys(key, entry)
+    return self.entryIcon(key, entry, keys and self.mc.get_multi(keys))
+
+  def chunkKeys(self, key, entry):
+    return ['%s-%d' % (key, i) for i in xrange(entry.get('chunks', 0))]
+
+  def entryIcon(self, key, entry, chunks):
+    '''Icon from an entry cacheIconData wrote under key and its chunks
+    ({key: chunk}), None when some are missing'''
+    if 'chunks' in entry:
+      keys = self.chunkKeys(key, entry)
+      if [k for k in keys if k not in chunks]:
+        cherrypy.log('key=%s : missing chunks, ignoring entry' % key,
+                     severity=WARN)
+        return None
+      entry = dict(entry, data=''.join(chunks[k] for k in keys))
+    return Icon.fromCache(entry)
+
+  def iconInStore(self, domain, location):
+    '''Returns the Icon self.store has for domain, or None. location is what
+    memcache has for domain: the store outlives memcache entries, so its
+    entry is served when memcache has nothing, and dropped when memcache
+    points at another icon or /clear evicted the domain.'''
+    key = self.cacheKey(domain)
+    entry = self.store and self.store.get(key)
+    if not entry:
+      return None
+    if location and location != entry['location']:
+      self.store.delete(key)
+      return None
+    if entry['location'] == globals.DEFAULT_FAVICON_LOC:
+      icon = self.default_icon
+    else:
+      icon = Icon.fromCache(entry)
+    self.local.set(self.cacheKey(domain), icon)
+    return icon
+
+  @stage('iconInCache')
+  def iconInCache(self, targetDomain, deadline):
+    key = self.cacheKey(targetDomain)
+    icon, icon_loc = self.local.get(key), None
+    if not icon:
+      icon_loc = self.mc.get(globals.KEY_FORMAT % key)
+      icon = self.iconInStore(targetDomain, icon_loc)
+    if icon:
+      cherrypy.log('URL:%s local cache hit, location=%s' % \
+                   (targetDomain, icon.location), severity=DEBUG)
+      self.counters.incr('hits')
+      if icon is self.default_icon:
+        self.counters.incr('defaults')
+      self.refreshIfStale(targetDomain, icon)
+      return icon
+
+    if icon_loc and icon_loc != globals.EVICTED_LOC:
+      cherrypy.log('URL:%s cache hit, location=%s' % (targetDomain, icon_loc),
+                   severity=DEBUG)
+
+      if icon_loc == globals.DEFAULT_FAVICON_LOC:
+        self.counters.incr('hits')
+        self.counters.incr('defaults')
+        self.local.set(key, self.default_icon)
+        return self.default_icon
+
+      icon = self.cachedIconData(targetDomain)
+      if icon and icon.location == icon_loc:
+        self.counters.incr('hits')
+        self.local.set(key, icon)
+        self.refreshIfStale(targetDomain, icon)
+        return icon
+
+      # icon data missing, nothing to serve while fetching it
+      try:
+        iconResult = self.open(icon_loc, deadline)
+        icon = self.validateIcon(iconResult)
+      except (TimeoutError, IOError) as e:
+        cherrypy.log("URL:%s, Error: %s" % (targetDomain, e),
+            severity=ERROR)
+        return None
+
+      if icon:
+        self.counters.incr('hits')
+        icon.location = icon_loc
+        self.local.set(key, icon)
+        self.cacheIconData(targetDomain, icon)
+        return icon
+      else:
+        cherrypy.log('URL:%s cached location no longer valid' % \
+                     targetDomain,
+                     severity=INFO)
+
+  def renditionKey(self, location, size):
+    return globals.RENDITION_KEY_FORMAT % \
+           (hashlib.md5(str(location)).hexdigest(), size)
+
+  def rendition(self, icon, size):
+    '''icon at size pixels as PNG, or icon itself if it can't be rendered'''
+    if icon.renditions and size in icon.renditions:
+      return icon.renditions[size]
+
+    key = self.renditionKey(icon.location, size)
+    sized = self.local.get(key)
+    if sized:
+      return sized
+
+    entry = self.mc.get(key)
+    if entry:
+      sized = Icon.fromCache(entry)
+    else:
+      data = rendition.render(icon.data, icon.type, size)
+      if not data:
+        return icon
+      sized = Icon(data=data, location=icon.location, type='image/png',
+                   validated=icon.validated)
+      self.mc.set(key, sized.toCache(), time=globals.MC_CACHE_TIME)
+    self.local.set(key, sized)
+    return sized
+
+  def refreshIfStale(self, domain, icon):
+    '''Entries past ICON_SOFT_TIME are still served, and refreshed in the
+    background; memcache drops them at MC_CACHE_TIME'''
+    if icon.validated and time() - icon.validated > globals.ICON_SOFT_TIME:
+      cherrypy.log('URL:%s stale, queueing refresh' % domain, severity=DEBUG)
+      self.refreshQueue.enqueue(self.cacheKey(domain), domain, icon)
+
+  def refresh(self, domain, cachedIcon):
+    '''Revalidates a stale entry against its cached location, with a
+    conditional request when the origin gave validators. Falls back to a
+    full lookup when the location no longer serves an icon (a 4xx or
+    something that isn't an icon), or when there is no cachedIcon: a domain
+    whose resolution was shed. Timeouts, connection failures and 5xx keep
+    the stale entry, it is tried again on a later hit.'''
+    if not cachedIcon:
+      if self.local.get(self.cacheKey(domain)):
+        # resolved since it was queued
+        return
+      targetPath, targetDomain = self.parse(str(domain))
+      self.resolveDomain(domain, targetPath, targetDomain, False,
+                         concurrency.Deadline(globals.TIMEOUT))
+      return
+
+    deadline = concurrency.Deadline(globals.TIMEOUT)
+    location = cachedIcon.location
+    headers = dict()
+    if cachedIcon.etag:
+      headers['If-None-Match'] = cachedIcon.etag
+    if cachedIcon.lastModified:
+      headers['If-Modified-Since'] = cachedIcon.lastModified
+
+    icon = None
+    try:
+      icon = self.validateIcon(self.open(location, deadline, headers=headers))
+    except urllib2.HTTPError as e:
+      e.close()
+      if e.code == 304:
+        cherrypy.log('URL:%s not modified' % location, severity=DEBUG)
+        self.notModified += 1
+        cachedIcon.validated = time()
+        self.cacheIcon(domain, location, cachedIcon)
+        return
+      cherrypy.log('URL:%s, refresh error: %s' % (location, e), severity=WARN)
+      if e.code >= 500:
+        return
+    except (TimeoutError, IOError) as e:
+      # origin down for now, not a sign the icon is gone
+      cherrypy.log('URL:%s, refresh error, keeping stale icon: %s' % \
+                   (location, e), severity=WARN)
+      return
+    except ValueError as e:
+      cherrypy.log('URL:%s, refresh error: %s' % (location, e), severity=WARN)
+
+    if icon:
+      icon.location = location
+      self.cacheIcon(domain, location, icon)
+      return
+
+    cherrypy.log('URL:%s cached location no longer valid, re-resolving' % \
+                 domain, severity=INFO)
+    targetPath, targetDomain = self.parse(str(domain))
+    self.resolveDomain(domain, targetPath, targetDomain, True,
+                       concurrency.Deadline(globals.TIMEOUT))
+
+  @stage('waitForLease')
+  def waitForLease(self, domain, deadline):
+    '''Takes the lease on resolving domain, or, if another process holds
+    it, polls the cache for that process's result until the lease runs out.
+    Returns (icon the other process found or None to resolve here,
+    whether the lease was taken).'''
+    if self.mc.add(globals.LEASE_KEY_FORMAT % self.cacheKey(domain), '1',
+                   time=globals.LEASE_TIME):
+      return None, True
+
+    cherrypy.log('URL:%s resolving elsewhere, waiting' % domain, severity=DEBUG)
+    self.leaseWaits += 1
+    while not deadline.expired():
+      sleep(globals.LEASE_POLL_INTERVAL)
+      icon = self.iconInCache(domain, deadline)
+      if icon:
+        self.leaseHits += 1
+        return icon, False
+      if not self.mc.get(globals.LEASE_KEY_FORMAT % self.cacheKey(domain)):
+        break
+    return None, False
+
+  def raceProbes(self, steps, deadline, names=None):
+    '''Runs the fallback chain concurrently, returning what running the steps
+    one by one would: the first step, in order, that finds an icon, or None
+    once deadline has passed.
+    steps are (method, args...) tuples; duplicates and steps with no
+    domain (their first argument) only run once or not at all. Each step
+    gets its share of the time left when it starts, fanout steps running at
+    once. The step that won is counted as winner-<name>, names labelling
+    the steps.'''
+    probes, seen, found = [], set(), dict()
+
+    def probe(i, position, method, args):
+      share = min(1.0, float(self.fanout) / (len(probes) - position))
+      found[i] = self.countStep(method, args + (deadline.share(share),))
+      return found[i]
+
+    for i, step in enumerate(steps):
+      if step in seen or not step[1]:
+        continue
+      seen.add(step)
+      method, args = step[0], step[1:]
+      probes.append(lambda i=i, position=len(probes), method=method, args=args:
+                    probe(i, position, method, args))
+
+    icon = concurrency.race(self.probePool, probes, self.fanout,
+                            max(0, deadline.remaining()))
+    if icon:
+      winner = min(i for i, result in found.items() if result is icon)
+      name = names[winner] if names else str(winner)
+      cherrypy.log('URL:%s found by step %s' % (icon.location, name),
+                   severity=DEBUG)
+      self.counters.incr('winner-%s' % name)
+    return icon
+
+  def countStep(self, method, args):
+    '''runs a fallback step, counting whether it found an icon'''
+    icon = method(*args)
+    self.counters.incr('step-%s-%s' % (method.__name__,
+                                       'found' if icon else 'missed'))
+    return icon
+
+  def cacheKey(self, domain):
+    '''the name domain's icon is cached under, the same for every spelling
+    of one site: see publicsuffix.canonicalHost'''
+    urlPieces = urlparse.urlparse(str(domain))
+    if not urlPieces.netloc:
+      return str(domain).lower()
+    return publicsuffix.canonicalHost(urlPieces.scheme, urlPieces.netloc)
+
+  def parentLocation(self, url):
+    '''parent location for 'investing.businessweek.com' is 'businessweek.com',
+    for 'news.bbc.co.uk' 'bbc.co.uk': the registrable domain, never a
+    public suffix like 'co.uk'. None when url is at that level already.'''
+    urlPieces = urlparse.urlparse(self.urldecode(url))
+    if not urlPieces.netloc or not urlPieces.scheme:
+      cherrypy.log('URL:%s, parent:void' % url, severity=DEBUG)
+      return None
+
+    host, port = publicsuffix.splitPort(urlPieces.netloc.lower())
+    parent = publicsuffix.registrableDomain(host)
+    if not parent or parent == host or 'www.' + parent == host:
+      return None
+    cherrypy.log('URL:%s, parent:%s' % (urlPieces.netloc, parent), severity=DEBUG)
+    return '%s://%s' % (urlPieces.scheme, parent + (':' + port if port else ''))
+
+  def wwwLocation(self, url):
+    '''www. in front of a registrable domain, None for anything else: other
+    subdomains, public suffixes and addresses don't have a www site'''
+    urlPieces = urlparse.urlparse(self.urldecode(url))
+    if not urlPieces.netloc or not urlPieces.scheme:
+      cherrypy.log('URL:%s, wwwLocation:void' % url, severity=DEBUG)
+      return None
+    host, port = publicsuffix.splitPort(urlPieces.netloc.lower())
+    if host.startswith('www.'):
+      cherrypy.log('URL:%s already has www' % url, severity=DEBUG)
+      return url
+    if publicsuffix.registrableDomain(host) != host:
+      return None
+    www = '%s://www.%s' % (urlPieces.scheme, urlPieces.netloc)
+    cherrypy.log('URL:%s, wwwLocation:%s' % (urlPieces.netloc, www), severity=DEBUG)
+    return www
+
+
+  def parse(self, url):
+    # Get page path
+    targetPath = self.urldecode(url)
+    if not targetPath.startswith('http'):
+      targetPath = 'http://%s' % targetPath
+    cherrypy.log('URL:%s, decoded' % targetPath, severity=DEBUG)
+
+    # Split path to get domain
+    targetURL = urlparse.urlparse(targetPath)
+    if not targetURL or not targetURL.scheme or not targetURL.netloc:
+      raise MalformedURLError('Malformed URL:%s' % url)
+
+    targetDomain = '%s://%s' % (targetURL.scheme, targetURL.netloc)
+    cherrypy.log('URL:%s, domain:%s' % (targetPath, targetDomain),
+                 severity=DEBUG)
+
+    return (targetPath, targetDomain)
+
+  @stage('resolve')
+  def resolve(self, url, skipCache=False, size=None, shed=False):
+    '''returns (icon, cacheHit); icon is self.default_icon when nothing
+    was found. With size, the icon is a PNG rendition of that many pixels
+    where one can be made.
+    Cache hits are answered straight away. Misses count against the
+    resolution budget; with shed, one beyond it raises Overloaded instead
+    of waiting on origins, its domain being resolved in the background.'''
+    deadline = concurrency.Deadline(globals.TIMEOUT)
+
+    self.counters.incr('requests')
+
+    targetPath, targetDomain = self.parse(str(url))
+
+    # icons are cached under the requested domain too, a hit needs no fetch
+    cachedIcon = not skipCache and self.iconInCache(targetDomain, deadline)
+    if cachedIcon:
+      result = cachedIcon, True
+    else:
+      result = self.resolveMiss(url, targetPath, targetDomain, skipCache,
+                                deadline, shed)
+    if size:
+      icon, cacheHit = result
+      return self.rendition(icon, size), cacheHit
+    return result
+
+  def resolveMiss(self, url, targetPath, targetDomain, skipCache, deadline,
+                  shed):
+    '''resolves a domain that missed the cache, within the budget'''
+    if not self.admission.enter(force=not shed):
+      cherrypy.log('URL:%s, shedding, %d resolutions in flight' % \
+                   (targetDomain, self.admission.limit), severity=WARN)
+      self.counters.incr('shed')
+      self.refreshQueue.enqueue(self.cacheKey(targetDomain), targetDomain, None)
+      raise Overloaded('%d resolutions in flight' % self.admission.limit)
+
+    try:
+      # concurrent misses for a domain share one trip to the origin
+      result, shared = self.flights.do((self.cacheKey(targetDomain), skipCache),
+          lambda: self.resolveDomain(url, targetPath, targetDomain, skipCache,
+                                     deadline),
+          max(0, deadline.remaining()))
+    finally:
+      self.admission.leave()
+    if not result:
+      cherrypy.log('URL:%s, gave up waiting on concurrent resolution' % \
+                   targetDomain, severity=WARN)
+      self.counters.incr('timeouts')
+      result = self.default_icon, False
+    return result
+
+  def resolveDomain(self, url, targetPath, targetDomain, skipCache, deadline):
+    '''the lookup proper for a domain that isn't cached, run once per domain
+    by resolve()'''
+    redirectedPath, redirectedDomain, page = targetPath, targetDomain, None
+    try:
+      redirectedPath, redirectedDomain, page = \
+          self.followRedirect(targetDomain, skipCache, deadline)
+    except (TimeoutError, IOError) as e:
+      cherrypy.log('URL:%s, Unexpected IOError %s' % (url,e), severity=WARN)
+
+    #set up parentDomain, steps without one are skipped
+    parentDomain = self.parentLocation(redirectedDomain)
+    if not parentDomain:
+      parentDomain = self.parentLocation(targetDomain)
+
+    # set up www.%s as last resort
+    wwwDomain = self.wwwLocation(redirectedDomain)
+    redirected = self.cacheKey(redirectedDomain) != self.cacheKey(targetDomain)
+
+    #extra lines from previous --
+    #last line is for sites like blogger.com at the time of this writing
+    cachedIcon, leased = None, False
+    if not skipCache:
+      cachedIcon = redirected and self.iconInCache(redirectedDomain, deadline)
+      if not cachedIcon:
+        cachedIcon, leased = self.waitForLease(redirectedDomain, deadline)
+    # the redirected page, when fetched above, is scanned as it is
+    steps = [(self.iconInResponse, redirectedDomain, redirectedPath, page,
+              skipCache) if page else
+             (self.iconInPage, redirectedDomain, redirectedPath, skipCache),
+             (self.iconAtRoot, redirectedDomain),
+             (self.iconInPage, parentDomain, parentDomain, skipCache),
+             (self.iconAtRoot, parentDomain),
+             (self.iconInPage, wwwDomain, wwwDomain, skipCache),
+             (self.iconAtRoot, wwwDomain),
+             (self.iconAtRoot, targetDomain)]
+    try:
+      # steps only find icons, the winner alone is cached below: a slower,
+      # lower priority step finishing after it mustn't overwrite it
+      icon = cachedIcon or self.raceProbes(steps, deadline, globals.STEP_NAMES)
+      if page:
+        # unread if the step never ran, which discards its connection
+        page.close()
+
+      if icon and not cachedIcon:
+        #cache in both places
+        self.cacheIcon(targetDomain, icon.location, icon)
+        if redirected:
+          self.cacheIcon(redirectedDomain, icon.location, icon)
+
+      if not icon:
+        cherrypy.log('URL:%s, falling back to default icon' % targetDomain,
+                     severity=DEBUG)
+
+        # transient failures shouldn't pin the default icon for long
+        probed = [urlparse.urljoin(step[1], '/favicon.ico')
+                  if step[0] == self.iconAtRoot else step[2] for step in steps
+                  if step[1]]
+        failures = self.negative.failures(probed)
+        # urls skipped only because their host is backing off are retried
+        # once the backoff ends
+        backingOff = [self.backoff.remaining(urlparse.urlparse(url).netloc)
+                      for url in probed if url not in failures]
+        ttl = min([self.negative.ttls[kind] for kind in failures.values()] +
+                  [r for r in backingOff if r] or [globals.MC_CACHE_TIME])
+        if deadline.expired():
+          cherrypy.log('URL:%s, out of time' % targetDomain, severity=WARN)
+          self.counters.incr('deadline_exceeded')
+          ttl = min(ttl, globals.NEGATIVE_TTL['timeout'])
+        self.cacheIcon(targetDomain, globals.DEFAULT_FAVICON_LOC, ttl=ttl)
+        self.counters.incr('defaults')
+        icon = self.default_icon
+    finally:
+      # only the lease this process took, another may be resolving it
+      if leased:
+        self.mc.delete(globals.LEASE_KEY_FORMAT % \
+                       self.cacheKey(redirectedDomain))
+
+    #only return times that are greater than a threshold
+    timeTaken = deadline.elapsed()
+    if timeTaken > globals.SLOW_RESOLUTION_TIME:
+      cherrypy.log('URL:%s, time taken to process: %f' % \
+          (targetDomain, timeTaken),
+          severity=WARN)
+    else:
+      cherrypy.log('URL:%s, time taken to process: %f' % \
+          (targetDomain, timeTaken),
+          severity=INFO)
+
+    return icon, bool(cachedIcon)
+
+  def resolveMany(self, urls, timeout):
+    '''Resolves urls together: one memcache multi-get for all their
+    domains, then concurrent lookups for the misses until timeout seconds
+    have passed. Returns {url: (domain, icon)}; domain is None for malformed
+    urls, icon is self.default_icon for lookups that didn't finish.'''
+    deadline = concurrency.Deadline(timeout)
+    domains, results = dict(), dict()
+    for url in urls:
+      try:
+        domains.setdefault(self.parse(str(url))[1], []).append(url)
+      except (MalformedURLError, UnicodeError):
+        results[url] = (None, None)
+
+    icons = dict()
+    for domain in domains:
+      icon = self.local.get(self.cacheKey(domain))
+      if icon:
+        self.refreshIfStale(domain, icon)
+        icons[domain] = icon
+
+    missing = [domain for domain in domains if domain not in icons]
+    keys = dict()
+    for domain in missing:
+      keys[globals.KEY_FORMAT % self.cacheKey(domain)] = domain
+      keys[globals.ICON_KEY_FORMAT % self.cacheKey(domain)] = domain
+    cached = keys and self.mc.get_multi(keys.keys()) or dict()
+    found = dict()
+    for domain in missing:
+      icon_loc = cached.get(globals.KEY_FORMAT % self.cacheKey(domain))
+      key = globals.ICON_KEY_FORMAT % self.cacheKey(domain)
+      entry = cached.get(key)
+      icon = self.iconInStore(domain, icon_loc)
+      if icon:
+        self.refreshIfStale(domain, icon)
+        icons[domain] = icon
+      elif icon_loc == globals.DEFAULT_FAVICON_LOC:
+        icons[domain] = self.default_icon
+      elif icon_loc and entry and entry['location'] == icon_loc:
+        found[domain] = (key, entry)
+    # and one more for the icons' bytes
+    chunkKeys = sum((self.chunkKeys(key, entry)
+                     for key, entry in found.values()), [])
+    chunks = chunkKeys and self.mc.get_multi(chunkKeys) or dict()
+    for domain, (key, entry) in found.items():
+      icon = self.entryIcon(key, entry, chunks)
+      if icon:
+        icons[domain] = icon
+        self.local.set(self.cacheKey(domain), icon)
+        self.refreshIfStale(domain, icon)
+
+    if icons:
+      self.counters.incr('requests', len(icons))
+      self.counters.incr('hits', len(icons))
+
+    futures = dict((domain, self.resolveAsync(domains[domain][0]))
+                   for domain in domains if domain not in icons)
+    for domain, future in futures.items():
+      result = future.result(max(0, deadline.remaining()))
+      icons[domain] = result[0] if result else self.default_icon
+
+    for domain, domainUrls in domains.items():
+      for url in domainUrls:
+        results[url] = (domain, icons[domain])
+    return results
+
+  def resolveAsync(self, url, skipCache=False):
+    '''resolve() on resolvePool, returns a concurrency.Future'''
+    return self.resolvePool.submit(self.resolve, url, skipCache)
+
+  def evict(self, url):
+    '''drops the cached icon for url's domain, where its root page
+    redirects and the icons that page declares; returns the domain'''
+    targetPath, targetDomain = self.parse(str(url))
+    key = self.cacheKey(targetDomain)
+    redirectKey = globals.REDIRECT_KEY_FORMAT % targetDomain
+    pages = [targetDomain, targetDomain + '/', targetPath,
+             self.mc.get(redirectKey)]
+    self.mc.set(globals.KEY_FORMAT % key, globals.EVICTED_LOC,
+                time=globals.EVICTED_TIME)
+    self.mc.delete_multi([globals.ICON_KEY_FORMAT % key, redirectKey] +
+                         [self.candidatesKey(page) for page in pages if page])
+    self.local.delete(key)
+    if self.store:
+      self.store.delete(key)
+    return targetDomain
+
+  def saveSnapshot(self, path, limit=globals.SNAPSHOT_ITEMS):
+    '''Writes the hottest limit entries of the local cache to path, for
+    loadSnapshot after a restart. Returns how many were written.'''
+    entries = []
+    for key, icon in self.local.items(limit):
+      entries.append((key, {'location': icon.location}
+                           if icon is self.default_icon else icon.toCache()))
+    # every process of a node saves on stop, each into its own file first
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary, 'wb') as f:
+      cPickle.dump(entries, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temporary, path)
+    cherrypy.log('Saved %d cache entries to %s' % (len(entries), path),
+                 severity=INFO)
+    return len(entries)
+
+  def loadSnapshot(self, path):
+    '''Puts the entries saveSnapshot wrote back in the local cache, hottest
+    last so they end up on top. Returns how many were loaded.'''
+    try:
+      with open(path, 'rb') as f:
+        entries = cPickle.load(f)
+    except (IOError, EOFError, ValueError, cPickle.UnpicklingError) as e:
+      cherrypy.log('No cache snapshot loaded from %s: %s' % (path, e),
+                   severity=WARN)
+      return 0
+
+    for key, entry in reversed(entries):
+      if entry['location'] == globals.DEFAULT_FAVICON_LOC:
+        self.local.set(key, self.default_icon)
+      else:
+        self.local.set(key, Icon.fromCache(entry))
+    cherrypy.log('Loaded %d cache entries from %s' % (len(entries), path),
+                 severity=INFO)
+    return len(entries)
+
+  def stats(self):
+    status = {'counters': self.counters.totals(['requests', 'hits', 'defaults'])}
+    status['local_cache'] = self.local.stats()
+    if isinstance(self.mc, ring.ShardedClient):
+      status['memcache'] = self.mc.stats()
+    if self.store:
+      status['store'] = self.store.stats()
+    status['http_pool'] = self.httpPool.stats()
+    status['negative_cache'] = self.negative.stats()
+    status['negative_cache'].update(self.backoff.stats())
+    status['refresh'] = self.refreshQueue.stats()
+    status['refresh']['not_modified'] = self.notModified
+    status['coalescing'] = self.flights.stats()
+    status['coalescing'].update(lease_waits=self.leaseWaits,
+                                lease_hits=self.leaseHits)
+    status['admission'] = self.admission.stats()
+    return status
+
+  def gauges(self):
+    '''current levels, as opposed to counters: resolutions in flight and
+    queued work'''
+    return {'resolutions_in_flight': self.admission.stats()['in_flight'],
+            'resolution_limit': self.admission.limit,
+            'refresh_queue_depth': self.refreshQueue.stats()['depth'],
+            'resolve_pool_pending': self.resolvePool.pending()}
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
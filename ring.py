@@ -0,0 +1,191 @@
+'''Consistent hashing over several memcache nodes.
+
+HashRing places each node at many points of a 32 bit ring, ketama style: 40
+md5 digests of "<node>-<n>" give 4 points each. A key belongs to the first
+node clockwise from the md5 of the key, so adding or removing a node only
+moves the keys between it and its neighbours.
+
+ShardedClient speaks the subset of memcache.Client the resolver uses, and
+sends each key to its node. A node whose connection fails is skipped for
+deadRetry seconds; its keys fail over to the next node on the ring.'''
+
+import bisect
+import hashlib
+import memcache
+import struct
+import threading
+
+from time import time
+
+class HashRing(object):
+
+  def __init__(self, nodes, digests=40):
+    super(HashRing, self).__init__()
+    self.nodes = list(nodes)
+    points = []
+    for node in self.nodes:
+      for i in xrange(digests):
+        digest = hashlib.md5('%s-%d' % (node, i)).digest()
+        for j in xrange(4):
+          points.append((struct.unpack('<I', digest[j * 4:j * 4 + 4])[0], node))
+    points.sort()
+    self.points = [point for point, node in points]
+    self.owners = [node for point, node in points]
+
+  def hash(self, key):
+    return struct.unpack('<I', hashlib.md5(key).digest()[:4])[0]
+
+  def walk(self, key):
+    '''yields each node once, in ring order from key's owner on'''
+    start = bisect.bisect(self.points, self.hash(key))
+    seen = set()
+    for i in xrange(len(self.owners)):
+      node = self.owners[(start + i) % len(self.owners)]
+      if node not in seen:
+        seen.add(node)
+        yield node
+        if len(seen) == len(self.nodes):
+          return
+
+  def node(self, key):
+    for node in self.walk(key):
+      return node
+
+class ShardedClient(object):
+
+  def __init__(self, nodes, deadRetry=30, debug=0):
+    super(ShardedClient, self).__init__()
+    self.ring = HashRing(nodes)
+    self.deadRetry = deadRetry
+    # one single-server client per node, hashing is ours
+    self.clients = dict((node, memcache.Client([node], debug=debug,
+                                               dead_retry=deadRetry))
+                        for node in nodes)
+    self.deadUntil = dict((node, 0) for node in nodes)
+    self.lock = threading.Lock()
+    self.counts = dict((node, {'gets': 0, 'hits': 0, 'sets': 0, 'errors': 0,
+                               'failovers': 0, 'calls': 0, 'seconds': 0.0})
+                       for node in nodes)
+
+  def alive(self, key):
+    '''key's nodes in failover order, skipping dead ones'''
+    now = time()
+    return [node for node in self.ring.walk(key) if self.deadUntil[node] <= now]
+
+  def _run(self, node, fn, *args):
+    '''calls fn on node's client, returns (result, failed)'''
+    client = self.clients[node]
+    started = time()
+    result = getattr(client, fn)(*args)
+    # memcache.Client doesn't raise, it marks the server dead instead
+    failed = bool(client.servers[0].deaduntil)
+    with self.lock:
+      counts = self.counts[node]
+      counts['calls'] += 1
+      counts['seconds'] += time() - started
+      if failed:
+        counts['errors'] += 1
+        self.deadUntil[node] = time() + self.deadRetry
+    return result, failed
+
+  def _call(self, fn, key, *args):
+    '''runs a single key command on the first live node that answers'''
+    for i, node in enumerate(self.alive(key)):
+      result, failed = self._run(node, fn, key, *args)
+      if failed:
+        continue
+      with self.lock:
+        counts = self.counts[node]
+        if i:
+          counts['failovers'] += 1
+        if fn == 'get':
+          counts['gets'] += 1
+          counts['hits'] += result is not None
+        elif fn in ('set', 'add'):
+          counts['sets'] += 1
+      return result
+    return None
+
+  def _group(self, keys):
+    '''{node: [key]} for keys, by their first live node'''
+    groups = dict()
+    for key in keys:
+      nodes = self.alive(key)
+      if nodes:
+        groups.setdefault(nodes[0], []).append(key)
+    return groups
+
+  def get(self, key):
+    return self._call('get', key)
+
+  def set(self, key, val, time=0):
+    return self._call('set', key, val, time) or False
+
+  def add(self, key, val, time=0):
+    return self._call('add', key, val, time) or False
+
+  def incr(self, key, delta=1):
+    return self._call('incr', key, delta)
+
+  def delete(self, key, time=0):
+    return self._call('delete', key, time) or 0
+
+  def get_multi(self, keys, key_prefix=''):
+    found = dict()
+    pending = [key_prefix + key for key in keys]
+    while pending:
+      retry = []
+      for node, nodeKeys in self._group(pending).items():
+        result, failed = self._run(node, 'get_multi', nodeKeys)
+        if failed:
+          retry.extend(nodeKeys)
+          continue
+        with self.lock:
+          self.counts[node]['gets'] += len(nodeKeys)
+          self.counts[node]['hits'] += len(result)
+        found.update(result)
+      pending = retry
+    return dict((key[len(key_prefix):], value) for key, value in found.items())
+
+  def set_multi(self, mapping, time=0, key_prefix=''):
+    '''returns the keys that couldn't be stored'''
+    notStored = []
+    pending = dict((key_prefix + key, value) for key, value in mapping.items())
+    while pending:
+      retry = dict()
+      groups = self._group(pending.keys())
+      for key in set(pending) - set(sum(groups.values(), [])):
+        notStored.append(key[len(key_prefix):])
+      for node, nodeKeys in groups.items():
+        result, failed = self._run(node, 'set_multi',
+            dict((key, pending[key]) for key in nodeKeys), time)
+        if failed:
+          retry.update((key, pending[key]) for key in nodeKeys)
+          continue
+        with self.lock:
+          self.counts[node]['sets'] += len(nodeKeys)
+        notStored.extend(key[len(key_prefix):] for key in result)
+      pending = retry
+    return notStored
+
+  def delete_multi(self, keys, time=0, key_prefix=''):
+    deleted = 1
+    for node, nodeKeys in self._group([key_prefix + key for key in keys]).items():
+      result, failed = self._run(node, 'delete_multi', nodeKeys, time)
+      deleted = deleted and result and not failed
+    return deleted and 1 or 0
+
+  def stats(self):
+    '''per node counts, latency and liveness'''
+    now = time()
+    with self.lock:
+      status = dict()
+      for node, counts in self.counts.items():
+        status[node] = dict((name, value) for name, value in counts.items()
+                            if name != 'seconds')
+        status[node]['alive'] = self.deadUntil[node] <= now
+        status[node]['avg_ms'] = counts['calls'] and \
+            round(counts['seconds'] * 1000 / counts['calls'], 3)
+      return status
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
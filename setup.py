@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(name='favicon',
       version='0.1',
       description='kikin favicon service',
-      packages=find_packages(),
+      packages=find_packages(exclude=['bench']),
       install_requires = ['BeautifulSoup>=3.2.0',
                           'CherryPy>=3.1.2',
                           'Jinja2>=2.5.5',
@@ -0,0 +1,78 @@
+'''In-process content type detection from magic bytes, covering the formats
+favicons actually come in. Returns the MIME strings libmagic() hands to
+validateIcon, or None when the signature is unknown.'''
+
+import re
+import struct
+
+RE_HTML = re.compile(r'<(!doctype\s+html|html|head|body|title|script|meta|link)[\s>]')
+RE_SVG = re.compile(r'<svg[\s>]')
+# what may come before an SVG's root element
+RE_PROLOG = re.compile(r'(\s+|<\?.*?\?>|<!--.*?-->|<!doctype\s+svg[^>]*>)',
+                       flags=re.DOTALL)
+
+# how far into a text document to look for markup
+TEXT_SNIFF_LENGTH = 1024
+
+def sniffIcon(string):
+  '''ICONDIR header: reserved=0, type=1 (icon) or 2 (cursor), count>0,
+  followed by 16 byte entries whose reserved byte is 0'''
+  if len(string) < 22:
+    return None
+  reserved, kind, count = struct.unpack('<HHH', string[:6])
+  if reserved != 0 or kind not in (1, 2) or not count:
+    return None
+  if string[9] != '\x00':
+    return None
+  return 'image/x-icon' if kind == 1 else 'image/x-win-bitmap'
+
+def rootElement(head):
+  '''head from its first element on, past any XML declaration, comments
+  and SVG doctype: an HTML page with inline <svg> isn't an SVG'''
+  position = 0
+  while True:
+    match = RE_PROLOG.match(head, position)
+    if not match:
+      return head[position:]
+    position = match.end()
+
+def sniffText(string):
+  head = string[:TEXT_SNIFF_LENGTH]
+  if head.startswith('\xef\xbb\xbf'):
+    head = head[3:]
+  head = head.lstrip().lower()
+  if not head.startswith('<'):
+    return None
+
+  if RE_SVG.match(rootElement(head)):
+    return 'image/svg+xml'
+  if head.startswith('<?xml'):
+    if RE_HTML.search(head):
+      return 'text/html'
+    return 'application/xml'
+  if RE_HTML.match(head) or head.startswith('<!--'):
+    return 'text/html'
+  return None
+
+def sniff(string):
+  if not string:
+    return None
+
+  if string.startswith('\x89PNG\r\n\x1a\n'):
+    return 'image/png'
+  if string.startswith('GIF87a') or string.startswith('GIF89a'):
+    return 'image/gif'
+  if string.startswith('\xff\xd8\xff'):
+    return 'image/jpeg'
+  if string.startswith('\x1f\x8b'):
+    return 'application/x-gzip'
+  if string.startswith('RIFF') and string[8:12] == 'WEBP':
+    return 'image/webp'
+  if string.startswith('BM') and len(string) > 18 and \
+     struct.unpack('<I', string[14:18])[0] in (12, 40, 52, 56, 64, 108, 124):
+    return 'image/bmp'
+  if string.startswith('\x00\x00'):
+    return sniffIcon(string)
+  return sniffText(string)
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
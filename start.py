@@ -43,7 +43,8 @@ cherrypy.config.update({'favicon.root' : ROOT + '/src'})
 
 if cherrypy.__version__.startswith('3.0') and cherrypy.engine.state == 0:
   cherrypy.engine.start(blocking=False)
-  atexit.register(cherrypy.engine.stop)
+# stopping publishes 'stop', on which the cache snapshot is saved
+atexit.register(cherrypy.engine.stop)
 
 import favicon
 
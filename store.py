@@ -0,0 +1,310 @@
+'''On-disk icon store, the tier between the local LRU cache and memcache.
+
+Icons live in one append-only segment file, read through mmap. Two kinds of
+records are appended to it:
+
+  blob    key: md5 of the icon bytes   value: the icon bytes
+  domain  key: domain                  value: JSON entry pointing at a blob
+                                              (empty value: deleted)
+
+Icon bytes are content addressed, so the many domains sharing an icon store
+it once. The index (digest -> blob position, domain -> entry) is kept in
+memory and rebuilt by scanning the segment when the store is opened, which
+is what lets it survive restarts; copying the segment warms a new node.
+Once the segment outgrows maxBytes, live entries are copied, newest first,
+into a fresh segment of at most maxBytes * compactRatio that replaces it.
+
+Several processes may share a segment, mod_wsgi workers or warmup.py next
+to a live node. Appends and compactions take an exclusive flock on it, and
+before appending a process indexes whatever the others wrote since its last
+look, reopening the segment when another process has compacted it.'''
+
+import fcntl
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from time import time
+
+BLOB, DOMAIN = 'B', 'D'
+# magic, kind, key length, value length, crc32 of key and value
+HEADER = struct.Struct('>2scHII')
+MAGIC = 'FS'
+SEGMENT = 'icons.seg'
+LOCK = 'icons.lock'
+
+class SegmentStore(object):
+
+  def __init__(self, path, maxBytes, compactRatio=0.5):
+    super(SegmentStore, self).__init__()
+    self.path = path
+    self.maxBytes = maxBytes
+    self.compactRatio = compactRatio
+    self.lock = threading.Lock()
+    self.compacting = False
+    self.hits = self.misses = self.compactions = 0
+
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    # the segment itself is replaced by compactions, the lock file never is
+    self.lockFile = open(os.path.join(path, LOCK), 'a')
+    with self._locked():
+      self._open(os.path.join(path, SEGMENT))
+
+  def _open(self, filename):
+    '''(re)opens the segment and rebuilds the index from it'''
+    self.filename = filename
+    self.file = open(filename, 'ab+')
+    self.map = None
+    self.blobs = dict()   # digest -> (offset, length)
+    self.domains = dict() # domain -> entry
+    self.size = self._scan()
+
+  def _locked(self):
+    '''exclusive flock on the store, against other processes'''
+    return FileLock(self.lockFile)
+
+  def _catchUp(self):
+    '''with the flock held: picks up what other processes did to the
+    segment since this one last wrote to it'''
+    try:
+      replaced = os.stat(self.filename).st_ino != \
+                 os.fstat(self.file.fileno()).st_ino
+    except OSError:
+      replaced = True
+    if replaced:
+      # compacted elsewhere, the file we hold is no longer the segment
+      self.file.close()
+      self._open(self.filename)
+    elif os.fstat(self.file.fileno()).st_size != self.size:
+      self.size = self._scan(self.size)
+
+  def _remap(self):
+    self.file.flush()
+    # readers still holding the previous map keep it alive until they're done
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) \
+               if os.fstat(self.file.fileno()).st_size else None
+
+  def _scan(self, offset=0):
+    '''indexes the records from offset on, returns where the valid records
+    end; a torn write at the end of the segment is cut off'''
+    self._remap()
+    length = self.map and len(self.map) or 0
+    while offset + HEADER.size <= length:
+      magic, kind, keyLength, valueLength, crc = \
+          HEADER.unpack_from(self.map, offset)
+      start = offset + HEADER.size
+      end = start + keyLength + valueLength
+      if magic != MAGIC or end > length or \
+         zlib.crc32(self.map[start:end]) & 0xffffffff != crc:
+        break
+      key = self.map[start:start + keyLength]
+      self._index(kind, key, start + keyLength, valueLength)
+      offset = end
+
+    if offset < length:
+      self.file.truncate(offset)
+      self._remap()
+    return offset
+
+  def _index(self, kind, key, offset, length):
+    if kind == BLOB:
+      self.blobs[key] = (offset, length)
+    elif length:
+      self.domains[key] = self._decode(self.map[offset:offset + length])
+    else:
+      self.domains.pop(key, None)
+
+  def _encode(self, entry):
+    # fields are bytes in whatever charset the origin sent (etags, urls),
+    # latin-1 maps each byte to one code point and back
+    return json.dumps(entry, encoding='latin-1')
+
+  def _decode(self, value):
+    # entries are written from str values, keep handing out str
+    return dict((str(name), _bytes(field) if isinstance(field, unicode)
+                            else field)
+                for name, field in json.loads(value).items())
+
+  def _append(self, kind, key, value):
+    '''writes one record at the end of the segment, with the flock held,
+    returns the offset of its value'''
+    record = key + value
+    self.file.seek(0, os.SEEK_END)
+    self.file.write(HEADER.pack(MAGIC, kind, len(key), len(value),
+                                zlib.crc32(record) & 0xffffffff) + record)
+    offset = self.size + HEADER.size + len(key)
+    self.size += HEADER.size + len(record)
+    return offset
+
+  def _read(self, offset, length):
+    if not self.map or offset + length > len(self.map):
+      self._remap()
+    return self.map[offset:offset + length]
+
+  def get(self, domain):
+    '''the entry cached for domain, shaped like Icon.toCache(), or None.
+    Its data is None when the domain has no icon of its own'''
+    with self.lock:
+      entry = self.domains.get(domain)
+      if not entry or entry['expires'] < time():
+        self.misses += 1
+        return None
+      entry = dict(entry)
+      digest = entry.pop('digest')
+      entry['data'] = None
+      if digest:
+        if digest not in self.blobs:
+          # blob dropped by a compaction that raced this entry's write
+          self.misses += 1
+          return None
+        entry['data'] = self._read(*self.blobs[digest])
+      self.hits += 1
+    entry.pop('expires')
+    return entry
+
+  def set(self, domain, entry, ttl):
+    '''stores entry (an Icon.toCache() dict, data optional) for domain'''
+    entry = dict(entry)
+    data = entry.pop('data', None)
+    digest = data and hashlib.md5(data).hexdigest()
+    entry.update(digest=digest, expires=time() + ttl)
+    value = self._encode(entry)
+
+    with self.lock:
+      with self._locked():
+        self._catchUp()
+        if digest and digest not in self.blobs:
+          self.blobs[digest] = (self._append(BLOB, digest, data), len(data))
+        self._append(DOMAIN, domain, value)
+        self.file.flush()
+      self.domains[domain] = entry
+      compact = self.size > self.maxBytes and not self.compacting
+      if compact:
+        self.compacting = True
+
+    if compact:
+      thread = threading.Thread(target=self.compact, name='store-compact')
+      thread.daemon = True
+      thread.start()
+
+  def delete(self, domain):
+    with self.lock:
+      with self._locked():
+        self._catchUp()
+        if domain in self.domains:
+          self._append(DOMAIN, domain, '')
+          self.file.flush()
+          del self.domains[domain]
+
+  def compact(self):
+    '''Rewrites the live, unexpired entries newest first into a new segment
+    until it reaches maxBytes * compactRatio, then swaps it in. Records
+    appended meanwhile are copied over as they are.'''
+    try:
+      with self.lock:
+        with self._locked():
+          self._catchUp()
+        snapshot = self.domains.items()
+        blobs = dict(self.blobs)
+        copied = self.size
+
+      now = time()
+      live = sorted([(domain, entry) for domain, entry in snapshot
+                     if entry['expires'] > now],
+                    key=lambda (domain, entry): entry.get('validated') or 0,
+                    reverse=True)
+
+      budget = self.maxBytes * self.compactRatio
+      # per process, two of them may be compacting at once
+      compactedName = '%s.%d.compact' % (self.filename, os.getpid())
+      compacted = open(compactedName, 'wb')
+      source = open(self.filename, 'rb')
+      written, seen = 0, set()
+      for domain, entry in live:
+        records = [(DOMAIN, domain, self._encode(entry))]
+        digest = entry['digest']
+        if digest and digest not in seen:
+          if digest not in blobs:
+            continue
+          offset, length = blobs[digest]
+          source.seek(offset)
+          records.insert(0, (BLOB, str(digest), source.read(length)))
+        size = sum(HEADER.size + len(key) + len(value)
+                   for kind, key, value in records)
+        if written + size > budget:
+          break
+        for kind, key, value in records:
+          compacted.write(HEADER.pack(MAGIC, kind, len(key), len(value),
+              zlib.crc32(key + value) & 0xffffffff) + key + value)
+        written += size
+        seen.add(digest)
+      source.close()
+
+      with self.lock:
+        with self._locked():
+          if os.stat(self.filename).st_ino != \
+             os.fstat(self.file.fileno()).st_ino:
+            # another process compacted meanwhile, keep its segment
+            compacted.close()
+            os.remove(compactedName)
+            self._catchUp()
+            return
+          # whatever was appended since the snapshot, here or elsewhere,
+          # goes over unchanged
+          source = open(self.filename, 'rb')
+          source.seek(copied)
+          compacted.write(source.read())
+          source.close()
+          compacted.flush()
+          os.fsync(compacted.fileno())
+          compacted.close()
+
+          os.rename(compactedName, self.filename)
+          self.file.close()
+          self._open(self.filename)
+        self.compactions += 1
+    finally:
+      self.compacting = False
+
+  def close(self):
+    with self.lock:
+      self.file.close()
+      self.lockFile.close()
+      self.map = None
+
+  def stats(self):
+    with self.lock:
+      return {'domains': len(self.domains), 'blobs': len(self.blobs),
+              'bytes': self.size, 'max_bytes': self.maxBytes,
+              'hits': self.hits, 'misses': self.misses,
+              'compactions': self.compactions}
+
+def _bytes(field):
+  try:
+    return field.encode('latin-1')
+  except UnicodeEncodeError:
+    # segments written before entries were encoded as latin-1
+    return field.encode('utf-8')
+
+class FileLock(object):
+  '''holds an exclusive flock on an open file for a with block'''
+
+  def __init__(self, file):
+    super(FileLock, self).__init__()
+    self.file = file
+
+  def __enter__(self):
+    fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, excType, exc, traceback):
+    fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+    return False
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85
@@ -0,0 +1,201 @@
+'''Warms or recrawls the icon cache by running domains through the resolver.
+
+  python warmup.py [-c dev.conf] [-n THREADS] [--rate PER_HOST_PER_SECOND]
+                   [--checkpoint FILE] [--recrawl] [--limit N] [SOURCE ...]
+
+SOURCEs are domain lists, one url or domain per line like topsites.txt, or
+access logs, from which the urls of /s requests are taken; without any,
+topsites.txt is read. Each domain is resolved once, in-process and with
+THREADS at a time, and the results land in the caches (local store,
+memcache) the configuration points at. Domains already done are appended
+to the checkpoint file, and skipped when the run is started again.
+--recrawl bypasses the cache so every icon is fetched again.
+'''
+import argparse
+import cherrypy
+import os
+import Queue
+import re
+import sys
+import threading
+import urlparse
+
+import publicsuffix
+import resolver
+
+from time import sleep, time
+
+RE_ACCESSLOG = re.compile(r'"GET /s/?\?(\S*) HTTP')
+
+def urls(sources):
+  '''yields the urls in sources, domain lists or access logs'''
+  for source in sources:
+    for line in open(source):
+      match = RE_ACCESSLOG.search(line)
+      if match:
+        for url in urlparse.parse_qs(match.group(1)).get('url', []):
+          yield url
+      elif '"' not in line:
+        line = line.strip()
+        if line and not line.startswith('#'):
+          yield line
+
+class RateLimiter(object):
+  '''spaces out requests to one host by at least 1/rate seconds'''
+
+  def __init__(self, rate):
+    super(RateLimiter, self).__init__()
+    self.interval = 1.0 / rate if rate else 0
+    self.lock = threading.Lock()
+    self.next = dict() # host -> earliest time of its next request
+
+  def wait(self, host):
+    if not self.interval:
+      return
+    with self.lock:
+      now = time()
+      at = max(now, self.next.get(host, 0))
+      self.next[host] = at + self.interval
+      if len(self.next) > 100000:
+        self.next = dict((h, t) for h, t in self.next.items() if t > now)
+    if at > now:
+      sleep(at - now)
+
+def site(domain):
+  '''what requests are spaced out per: the registrable domain, so a site's
+  subdomains share one rate, or the host when it has none'''
+  host = publicsuffix.splitPort(urlparse.urlparse(domain).netloc.lower())[0]
+  return publicsuffix.registrableDomain(host) or host
+
+def percentile(ordered, fraction):
+  if not ordered:
+    return 0
+  return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class Report(object):
+
+  def __init__(self):
+    super(Report, self).__init__()
+    self.lock = threading.Lock()
+    self.started = time()
+    self.latencies = []
+    self.found = self.defaults = self.hits = self.errors = self.skipped = 0
+
+  def add(self, seconds, icon, cacheHit, defaultIcon):
+    with self.lock:
+      self.latencies.append(seconds)
+      if icon is defaultIcon:
+        self.defaults += 1
+      else:
+        self.found += 1
+      self.hits += cacheHit
+
+  def error(self):
+    with self.lock:
+      self.errors += 1
+
+  def line(self):
+    with self.lock:
+      ordered = sorted(self.latencies)
+      done = len(ordered) + self.errors
+    elapsed = time() - self.started
+    return ('%d done (%d skipped) in %.0fs, %.1f/s | found %.1f%% default '
+            '%.1f%% errors %d cache hits %d | p50 %.2fs p90 %.2fs p99 %.2fs') % \
+        (done, self.skipped, elapsed, done / max(elapsed, 0.001),
+         100.0 * self.found / max(done, 1), 100.0 * self.defaults / max(done, 1),
+         self.errors, self.hits, percentile(ordered, 0.5),
+         percentile(ordered, 0.9), percentile(ordered, 0.99))
+
+def work(engine, queue, limiter, report, checkpoint, recrawl):
+  while True:
+    item = queue.get()
+    if item is None:
+      return
+    url, domain = item
+    limiter.wait(site(domain))
+    started = time()
+    try:
+      icon, cacheHit = engine.resolve(url, skipCache=recrawl)
+    except Exception as e:
+      report.error()
+      print >> sys.stderr, 'URL:%s, Error: %s' % (url, e)
+      continue
+    report.add(time() - started, icon, cacheHit, engine.default_icon)
+    if checkpoint:
+      with report.lock:
+        checkpoint.write(url + '\n')
+        checkpoint.flush()
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('-c', '--config', default='dev.conf')
+  parser.add_argument('-n', '--threads', type=int, default=20)
+  parser.add_argument('--rate', type=float, default=1.0,
+                      help='requests per second to any one host, 0 for no limit')
+  parser.add_argument('--checkpoint')
+  parser.add_argument('--recrawl', action='store_true')
+  parser.add_argument('--limit', type=int)
+  parser.add_argument('--report-every', type=float, default=10)
+  parser.add_argument('sources', nargs='*')
+  args = parser.parse_args()
+
+  cherrypy.config.update(args.config)
+  cherrypy.config.update({'favicon.root': os.getcwd()})
+  engine = resolver.Resolver(cherrypy.config)
+
+  done = set()
+  if args.checkpoint and os.path.exists(args.checkpoint):
+    done = set(line.strip() for line in open(args.checkpoint))
+  checkpoint = args.checkpoint and open(args.checkpoint, 'a')
+
+  report = Report()
+  limiter = RateLimiter(args.rate)
+  queue = Queue.Queue(maxsize=args.threads * 2)
+  threads = [threading.Thread(target=work, args=(engine, queue, limiter,
+                              report, checkpoint, args.recrawl))
+             for i in xrange(args.threads)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+
+  def progress():
+    while True:
+      sleep(args.report_every)
+      print report.line()
+  reporter = threading.Thread(target=progress)
+  reporter.daemon = True
+  reporter.start()
+
+  seen, queued = set(), 0
+  try:
+    for url in urls(args.sources or ['topsites.txt']):
+      try:
+        domain = engine.parse(str(url))[1]
+      except (resolver.MalformedURLError, UnicodeError):
+        continue
+      if engine.cacheKey(domain) in seen:
+        continue
+      seen.add(engine.cacheKey(domain))
+      if url in done or domain in done:
+        report.skipped += 1
+        continue
+      queue.put((url, domain))
+      queued += 1
+      if args.limit and queued >= args.limit:
+        break
+
+    for thread in threads:
+      queue.put(None)
+    for thread in threads:
+      while thread.isAlive():
+        thread.join(1)
+  except KeyboardInterrupt:
+    print 'interrupted, rerun with the same --checkpoint to resume'
+
+  engine.counters.flush()
+  print report.line()
+
+if __name__ == '__main__':
+  main()
+
+# vim: sts=2:sw=2:ts=2:tw=85:cc=85